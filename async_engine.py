@@ -0,0 +1,309 @@
+import asyncio
+import time
+
+from engine import (
+    finish_game_turn,
+    finish_turn,
+    prepare_init_rewrite_prompt,
+    prepare_rewrite_prompt,
+    start_game_turn,
+    start_turn,
+)
+from game import (
+    try_to_fix_parser_error,
+    is_parser_error_async,
+    peek_parser_error,
+    get_current_room,
+)
+from utils import (
+    write_to_debug_log,
+    get_llm_response_for_current_prompt_async,
+    get_llm_response_stream_for_current_prompt_async,
+)
+from state import get_current_state
+from tracing import span
+
+
+class TurnGraph:
+    """
+    The async steps of one turn and the steps each depends on. Each step is
+    started as soon as its dependencies are done, so steps that don't depend
+    on each other run concurrently.
+    """
+
+    def __init__(self):
+        self.steps = {}
+
+    def add(self, name, fn, depends_on=()):
+        """
+        Adds a step that awaits fn() with the results of the steps it depends
+        on as arguments. A step can be replaced by adding another with the same name.
+        """
+        dependencies = [self.steps[d] for d in depends_on]
+
+        async def run():
+            # Shielded, so cancelling this step doesn't cancel steps it depends on
+            results = [await asyncio.shield(d) for d in dependencies]
+            return await fn(*results)
+
+        self.steps[name] = asyncio.ensure_future(run())
+
+    async def result(self, name):
+        return await self.steps[name]
+
+    def cancel(self, name):
+        self.steps[name].cancel()
+
+
+async def check_parser_error_async(command, response):
+    with span("is_parser_error"):
+        return await is_parser_error_async(command, response)
+
+
+async def rewrite_response_async(command, response, current_room, is_error):
+    """
+    Like engine.rewrite_response(), but awaits the LLM without blocking the
+    event loop. The current room and parser error check must be given.
+    """
+    if not response:
+        return response
+
+    with span("rewrite"):
+        input = prepare_rewrite_prompt(command, response, current_room, is_error)
+        llm_response = await get_llm_response_for_current_prompt_async()
+
+    if input == True:
+        llm_response = llm_response + "\n\n>"
+    return llm_response
+
+
+async def rewrite_response_stream_async(command, response, current_room, is_error):
+    """
+    Like engine.rewrite_response_stream(), but an async generator. The current
+    room and parser error check must be given.
+    """
+    if not response:
+        return
+
+    with span("rewrite"):
+        input = prepare_rewrite_prompt(command, response, current_room, is_error)
+        async for segment in get_llm_response_stream_for_current_prompt_async():
+            yield segment
+
+    if input == True:
+        yield "\n\n>"
+
+
+def add_lookup_steps(graph, command, response):
+    """
+    Adds the steps that rewriting a game response needs, which don't depend on
+    each other: checking whether it's a parser error, and looking up the room
+    """
+    if "is_error" not in graph.steps:
+        graph.add("is_error", lambda: check_parser_error_async(command, response))
+    graph.add("room", lambda: asyncio.to_thread(get_current_room))
+
+
+def add_rewrite_steps(graph, command, response, guessed_error):
+    """
+    Adds the steps for checking and rewriting a game response. The rewrite
+    doesn't wait for the parser error check; it optimistically starts with the
+    guessed answer, which finish_rewrite() corrects if it turns out to be wrong.
+    """
+    add_lookup_steps(graph, command, response)
+    graph.add(
+        "rewrite",
+        lambda room: rewrite_response_async(command, response, room, guessed_error),
+        depends_on=["room"],
+    )
+
+
+async def finish_rewrite(graph, command, response, guessed_error):
+    """
+    Waits for the rewrite steps added by add_rewrite_steps(), redoing the
+    rewrite if the parser error check didn't match the guess.
+    """
+    is_error = await graph.result("is_error")
+    if is_error != guessed_error:
+        graph.cancel("rewrite")
+        graph.add(
+            "rewrite",
+            lambda room: rewrite_response_async(command, response, room, is_error),
+            depends_on=["room"],
+        )
+    return await graph.result("rewrite")
+
+
+async def run_command_async(input_command, add_steps):
+    """
+    Like engine.run_command(), but awaits the parser error check without
+    blocking the event loop, and fixes errors on a worker thread.
+
+    While the response is being checked, add_steps(graph, command, response,
+    guessed_error) adds the steps that get the response ready for rewriting;
+    they're dropped if the check finds a parser error.
+
+    Returns the command actually given to the game, the game response, whether
+    the game is over, the steps for the response, and the guessed parser error check.
+    """
+    state = get_current_state()
+
+    write_to_debug_log(f"=== User Input ===\n{input_command}\n\n")
+
+    with span("env.get_state"):
+        temp_game_state = state.env.get_state()
+    with span("env.step"):
+        game_response, _, is_game_over, ___ = state.env.step(input_command)
+
+    write_to_debug_log(f"=== Game Response ===\n{game_response}\n\n")
+
+    # Without a cached answer, most responses are not parser errors.
+    # If we already know it is one, there's no point getting ready to rewrite it.
+    guessed_error = peek_parser_error(input_command, game_response)
+    graph = TurnGraph()
+    graph.add("is_error", lambda: check_parser_error_async(input_command, game_response))
+    if state.tone != "none" and not guessed_error:
+        add_steps(graph, input_command, game_response, False)
+
+    # If we detected parse error, try LLM rewrite
+    if not await graph.result("is_error"):
+        return input_command, game_response, is_game_over, graph, guessed_error or False
+
+    write_to_debug_log("UNRECOGNIZED COMMAND: " + input_command + "\n\n")
+
+    # Drop the rewrite of the error, and make sure the room lookup
+    # is done with the emulator before we touch it again
+    if "rewrite" in graph.steps:
+        graph.cancel("rewrite")
+    if "room" in graph.steps:
+        await graph.result("room")
+
+    # First, we roll back to the state before error, just in case
+    # the failed command changes game state.
+    with span("env.set_state"):
+        state.env.set_state(temp_game_state)
+
+    with span("fix_parser_error"):
+        game_command = await asyncio.to_thread(
+            try_to_fix_parser_error, input_command, game_response
+        )
+    write_to_debug_log(f"=== Alt. User Input ===\n{game_command}\n\n")
+
+    with span("env.step"):
+        game_response, _, is_game_over, ___ = state.env.step(game_command)
+    write_to_debug_log(f"=== Alt. Game Response===\n{game_response}\n\n")
+
+    # Note that the response is checked and rewritten with the original user input
+    guessed_error = peek_parser_error(input_command, game_response) or False
+    graph = TurnGraph()
+    if state.tone != "none":
+        add_steps(graph, input_command, game_response, guessed_error)
+    return game_command, game_response, is_game_over, graph, guessed_error
+
+
+async def start_new_game_async():
+    """
+    Like engine.start_new_game(), for use from async code
+    """
+    state = get_current_state()
+    start = time.perf_counter()
+
+    # Initial response, rewritten with LLM
+    game_response = start_game_turn()
+    if state.tone == "none":
+        llm_response = game_response
+    else:
+        with span("rewrite"):
+            prepare_init_rewrite_prompt(game_response)
+            llm_response = await get_llm_response_for_current_prompt_async()
+
+    await asyncio.to_thread(finish_game_turn, start)
+    return None, None, game_response, llm_response, False
+
+
+async def process_input_async(input_command):
+    """
+    Like engine.process_input(), but runs the independent steps of the turn
+    concurrently: the room lookup and response rewrite don't wait for the
+    LLM's parser error check, and are redone only if it disagrees.
+    """
+    state = get_current_state()
+    start = time.perf_counter()
+
+    prefetched = start_turn(input_command)
+    if prefetched:
+        game_command = prefetched["game_command"]
+        game_response = prefetched["game_response"]
+        is_game_over = prefetched["is_game_over"]
+        llm_response = prefetched["llm_response"]
+    else:
+        game_command, game_response, is_game_over, graph, guessed_error = (
+            await run_command_async(input_command, add_rewrite_steps)
+        )
+
+        # Finally, finish the LLM rewrite for the game response
+        # Note that we're writing with the original user input
+        if state.tone == "none":
+            llm_response = game_response
+        else:
+            llm_response = await finish_rewrite(
+                graph, input_command, game_response, guessed_error
+            )
+
+    await asyncio.to_thread(
+        finish_turn, start, game_command, game_response, is_game_over, prefetched
+    )
+    return input_command, game_command, game_response, llm_response, is_game_over
+
+
+async def process_input_stream_async(input_command):
+    """
+    Like engine.process_input_stream(), but an async generator. The room lookup
+    runs while the response is checked for parser errors, and the rewrite
+    starts as soon as both are done.
+    """
+    state = get_current_state()
+    start = time.perf_counter()
+
+    prefetched = start_turn(input_command)
+    if prefetched:
+        game_command = prefetched["game_command"]
+        game_response = prefetched["game_response"]
+        is_game_over = prefetched["is_game_over"]
+    else:
+        # The rewrite is streamed to the player, so it can't start on a guess
+        game_command, game_response, is_game_over, graph, _ = await run_command_async(
+            input_command,
+            lambda graph, command, response, _: add_lookup_steps(graph, command, response),
+        )
+    yield {
+        "type": "game_response",
+        "input_command": input_command,
+        "game_command": game_command,
+        "game_response": game_response,
+        "is_game_over": is_game_over,
+    }
+
+    segments = []
+    try:
+        if prefetched:
+            segments.append(prefetched["llm_response"])
+            yield {"type": "llm_response", "text": prefetched["llm_response"]}
+        elif state.tone == "none":
+            segments.append(game_response)
+            yield {"type": "llm_response", "text": game_response}
+        else:
+            is_error = await graph.result("is_error")
+            current_room = await graph.result("room")
+            async for segment in rewrite_response_stream_async(
+                input_command, game_response, current_room, is_error
+            ):
+                segments.append(segment)
+                yield {"type": "llm_response", "text": segment}
+    finally:
+        # The command has run even if the rewrite was cut short, so keep the log in sync
+        await asyncio.to_thread(
+            finish_turn, start, game_command, game_response, is_game_over, prefetched
+        )
+
+    yield {"type": "done", "llm_response": "".join(segments)}
@@ -0,0 +1,202 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from state import llm_config
+
+
+def read_transcripts(paths):
+    """
+    Yields the transcripts in the given files, either one JSON object per file
+    (.json) or one per line (.jsonl). Each has "game", "commands", and optionally
+    "id", "tone" and "llm". Transcripts without an id are named by file and line.
+    """
+    for path in paths:
+        with open(path, "r") as f:
+            if path.endswith(".jsonl"):
+                lines = [(n, line) for n, line in enumerate(f, start=1) if line.strip()]
+            else:
+                lines = [(1, f.read())]
+
+        for line_number, text in lines:
+            transcript = json.loads(text)
+            transcript.setdefault("id", f"{path}:{line_number}")
+            yield transcript
+
+
+def read_finished_ids(output_path):
+    """
+    Returns the ids of transcripts already rewritten in the output file, so an
+    interrupted or partly failed run can pick up where it left off
+    """
+    finished = set()
+    try:
+        with open(output_path, "r") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue  # skip a partially written last line
+                if "error" in result:
+                    finished.discard(result["id"])
+                else:
+                    finished.add(result["id"])
+    except FileNotFoundError:
+        pass
+    return finished
+
+
+def init_worker(cassette_path, debug_logs):
+    global keep_debug_logs
+    keep_debug_logs = debug_logs
+    if cassette_path:
+        llm_config["cassette"]["path"] = cassette_path
+
+
+def rewrite_transcript(transcript, llm, tone):
+    """
+    Plays the transcript's commands in a new game session, returning the
+    rewritten response for each turn. Runs in a worker process.
+
+    Rewrite prompts only depend on the game's own responses, so all the turns
+    are played first and then rewritten together in one batch.
+    """
+    # Imported here so only worker processes load the games and LLM clients
+    import engine
+    from state import init_game_state, set_current_state
+
+    start = time.perf_counter()
+    game_path = transcript["game"]
+    if not os.path.dirname(game_path):
+        game_path = os.path.join("games", game_path)
+
+    state = init_game_state(
+        game_path,
+        transcript.get("llm") or llm,
+        transcript.get("tone") or tone,
+        id_in_log_path=True,
+    )
+    if not keep_debug_logs:
+        state.log_dir = None
+    set_current_state(state)
+
+    try:
+        input_command, game_command, game_response, rewrite, is_game_over = (
+            engine.start_new_game(defer_rewrite=True)
+        )
+        turns = [_turn(input_command, game_command, game_response)]
+        rewrites = [rewrite]
+        for command in transcript["commands"]:
+            if is_game_over:
+                break
+            input_command, game_command, game_response, rewrite, is_game_over = (
+                engine.process_input(command, defer_rewrite=True)
+            )
+            turns.append(_turn(input_command, game_command, game_response))
+            rewrites.append(rewrite)
+
+        for turn, llm_response in zip(turns, engine.rewrite_prepared(rewrites)):
+            turn["llm_response"] = llm_response
+    finally:
+        if state.debug_log:
+            state.debug_log.close()
+        state.env.close()
+
+    return {
+        "id": transcript["id"],
+        "game": transcript["game"],
+        "tone": state.tone,
+        "llm": state.llm_provider,
+        "turns": turns,
+        "duration": time.perf_counter() - start,
+    }
+
+
+def _turn(input_command, game_command, game_response):
+    return {
+        "input_command": input_command,
+        "game_command": game_command,
+        "game_response": game_response,
+    }
+
+
+def report_throughput(done, failed, turns, start):
+    elapsed = time.perf_counter() - start
+    print(
+        f"{done} transcripts ({failed} failed), {turns} turns in {elapsed:.1f}s: "
+        f"{done / elapsed:.2f} transcripts/s, {turns / elapsed:.2f} turns/s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rewrites recorded play transcripts without the UI, in parallel sessions"
+    )
+    parser.add_argument("transcripts", nargs="+", help=".json or .jsonl transcript files")
+    parser.add_argument("-o", "--output", required=True, help="JSON lines file to write results to")
+    parser.add_argument(
+        "-l",
+        "--llm",
+        help="LLM provider, for transcripts that don't give one",
+        choices=["together", "anthropic", "openai", "hosted", "record", "replay", "stub"],
+        default="anthropic",
+    )
+    parser.add_argument(
+        "-t",
+        "--tone",
+        help="Tone of rewrite, for transcripts that don't give one",
+        choices=["none", "original", "pratchett", "gumshoe", "legal", "spaceopera"],
+        default="pratchett",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=os.cpu_count(), help="Worker processes"
+    )
+    parser.add_argument("-c", "--cassette", help="Cassette file to record to or replay from")
+    parser.add_argument(
+        "--debug-logs", action="store_true", help="Write a debug log for each transcript"
+    )
+
+    args = parser.parse_args()
+    load_dotenv()
+
+    finished = read_finished_ids(args.output)
+    transcripts = [t for t in read_transcripts(args.transcripts) if t["id"] not in finished]
+    if finished:
+        print(f"Skipping {len(finished)} transcripts already in {args.output}", file=sys.stderr)
+
+    start = time.perf_counter()
+    done = failed = turns = 0
+    # Spawned rather than forked, since this process may have threads running
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(args.cassette, args.debug_logs),
+    ) as pool, open(args.output, "a") as output:
+        futures = {
+            pool.submit(rewrite_transcript, transcript, args.llm, args.tone): transcript
+            for transcript in transcripts
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+                turns += len(result["turns"])
+            except Exception as e:
+                # Recorded so it's retried on the next run
+                result = {"id": futures[future]["id"], "error": repr(e)}
+                failed += 1
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+
+            done += 1
+            if done % 10 == 0:
+                report_throughput(done, failed, turns, start)
+
+    report_throughput(done, failed, turns, start)
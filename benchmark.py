@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from state import config, llm_config, init_game_state, set_current_state
+
+GAMES = ["games/zork1.z5", "games/905.z5", "games/lostpig.z8"]
+
+# Ways players commonly phrase commands that parsers don't understand
+MISPHRASINGS = [
+    "please {command}",
+    "i would like to {command}",
+    "{command} right now",
+    "could you {command} for me",
+]
+
+
+def benchmark_commands(walkthrough, misphrase_every):
+    """
+    Yields the walkthrough commands, with a mis-phrased version of every
+    misphrase_every-th command inserted before it, as (command, is_misphrased)
+    """
+    for i, command in enumerate(walkthrough):
+        if misphrase_every and i % misphrase_every == misphrase_every - 1:
+            template = MISPHRASINGS[(i // misphrase_every) % len(MISPHRASINGS)]
+            yield template.format(command=command.lower()), True
+        yield command, False
+
+
+def timed_turn(run_turn):
+    """
+    Runs one turn with tracing, returning its result and timings
+    """
+    tracing.start_trace()
+    start = time.perf_counter()
+    result = run_turn()
+    duration = time.perf_counter() - start
+    trace = tracing.end_trace()
+
+    llm_calls = trace.find("llm_inference")
+    return result, {
+        "duration": duration,
+        "stages": trace.stage_totals(),
+        "llm_calls": len(llm_calls),
+        "prompt_chars": [call["attributes"]["prompt_chars"] for call in llm_calls],
+    }
+
+
+def benchmark_game(game_path, llm, tone, max_turns, misphrase_every):
+    state = init_game_state(game_path, llm, tone)
+    set_current_state(state)
+    walkthrough = state.env.get_walkthrough()[:max_turns]
+
+    _, turn = timed_turn(engine.start_new_game)
+    turns = [dict(turn, command=None, game_command=None, is_misphrased=False, is_fixed=None)]
+
+    for command, is_misphrased in benchmark_commands(walkthrough, misphrase_every):
+        # Mis-phrased commands are undone afterwards, so the walkthrough stays on track
+        saved_game_state = state.env.get_state()
+        result, turn = timed_turn(lambda: engine.process_input(command))
+
+        _, game_command, game_response, _, is_game_over = result
+        # A mis-phrased command only counts as fixed if the game understood the fix
+        is_fixed = None
+        if is_misphrased:
+            is_fixed = game_command != command and not game.is_parser_error(
+                game_command, game_response
+            )
+            state.env.set_state(saved_game_state)
+
+        turns.append(
+            dict(
+                turn,
+                command=command,
+                game_command=game_command,
+                is_misphrased=is_misphrased,
+                is_fixed=is_fixed,
+            )
+        )
+        if is_game_over and not is_misphrased:
+            break
+
+    return {
+        "turns": turns,
+        "summary": {
+            "all": summarize(turns),
+            "walkthrough": summarize([t for t in turns if not t["is_misphrased"]]),
+            "misphrased": summarize([t for t in turns if t["is_misphrased"]]),
+        },
+    }
+
+
+def summarize(turns):
+    if not turns:
+        return {"turns": 0}
+
+    durations = sorted([t["duration"] for t in turns])
+    prompt_chars = [chars for t in turns for chars in t["prompt_chars"]]
+    fixes = [t["is_fixed"] for t in turns if t["is_fixed"] is not None]
+    stages = {}
+    for turn in turns:
+        for name, duration in turn["stages"].items():
+            stages[name] = stages.get(name, 0.0) + duration
+
+    return {
+        "turns": len(turns),
+        "total": sum(durations),
+        "mean": statistics.mean(durations),
+        "p50": durations[len(durations) // 2],
+        "p95": durations[min(int(len(durations) * 0.95), len(durations) - 1)],
+        "max": durations[-1],
+        # Stage times include the stages nested inside them
+        "stage_totals": stages,
+        "stage_means": {name: total / len(turns) for name, total in stages.items()},
+        "llm_calls_per_turn": sum([t["llm_calls"] for t in turns]) / len(turns),
+        "mean_prompt_chars": statistics.mean(prompt_chars) if prompt_chars else 0,
+        "max_prompt_chars": max(prompt_chars) if prompt_chars else 0,
+        # Mis-phrased commands rewritten into ones the game understood
+        "parser_fixes": sum(fixes),
+        "parser_fix_rate": sum(fixes) / len(fixes) if fixes else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Plays through game walkthroughs, timing each turn of the engine"
+    )
+    parser.add_argument("games", nargs="*", default=GAMES)
+    parser.add_argument(
+        "-l",
+        "--llm",
+        help="LLM provider",
+        choices=["stub", "replay", "together", "anthropic", "openai", "hosted"],
+        default="stub",
+    )
+    parser.add_argument(
+        "-t",
+        "--tone",
+        help="Tone of rewrite",
+        choices=["none", "original", "pratchett", "gumshoe", "legal", "spaceopera"],
+        default="pratchett",
+    )
+    parser.add_argument("-c", "--cassette", help="Cassette file to replay LLM responses from")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        help="Median seconds the stub or replayed LLM takes to respond",
+    )
+    parser.add_argument(
+        "--latency-sigma",
+        type=float,
+        default=0.3,
+        help="Spread of the simulated LLM latency (lognormal sigma)",
+    )
+    parser.add_argument("--turns", type=int, default=100, help="Most walkthrough commands per game")
+    parser.add_argument(
+        "--misphrase-every",
+        type=int,
+        default=5,
+        help="Insert a mis-phrased command before every Nth walkthrough command (0 for none)",
+    )
+    parser.add_argument(
+        "--warm-caches",
+        action="store_true",
+        help="Use the on-disk caches of parser errors and learned rewrites "
+        "(only live LLM providers use them)",
+    )
+    parser.add_argument("-o", "--output", help="File to write the JSON results to")
+
+    args = parser.parse_args()
+    load_dotenv()
+
+    if args.cassette:
+        llm_config["cassette"]["path"] = args.cassette
+    if args.latency is not None:
+        llm_config["stub"]["latency_median"] = args.latency
+        llm_config["stub"]["latency_sigma"] = args.latency_sigma
+        llm_config["cassette"]["replay_latency"] = "lognormal"
+        llm_config["cassette"]["replay_latency_median"] = args.latency
+        llm_config["cassette"]["replay_latency_sigma"] = args.latency_sigma
+    if not args.warm_caches:
+        # Start from nothing learned, so runs are comparable
+        config["cache"]["parser_error_cache_on_disk"] = False
+        config["cache"]["rewrite_table_on_disk"] = False
+
+    # Imported after the config changes above, since they're read on import
+    import engine
+    import game
+    import tracing
+
+    results = {
+        "config": {
+            "llm": args.llm,
+            "tone": args.tone,
+            "latency": args.latency,
+            "latency_sigma": args.latency_sigma if args.latency is not None else None,
+            "turns": args.turns,
+            "misphrase_every": args.misphrase_every,
+            "warm_caches": args.warm_caches,
+        },
+        "games": {},
+    }
+    for game_path in args.games:
+        print(f"Benchmarking {game_path}...", file=sys.stderr)
+        results["games"][os.path.basename(game_path)] = benchmark_game(
+            game_path, args.llm, args.tone, args.turns, args.misphrase_every
+        )
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
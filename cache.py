@@ -0,0 +1,195 @@
+import fcntl
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class LRUCache:
+    """
+    A thread-safe, size-capped least-recently-used cache.
+
+    Concurrent lookups of the same missing key through get_or_compute() are
+    deduplicated, so only one caller computes the value while the rest wait.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight = {}  # key -> threading.Event for values being computed
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._put_locked(key, value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for key, calling compute() to fill it in on a
+        miss. If another thread is already computing the same key, waits for
+        its result instead of computing it again.
+        """
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return self._entries[key]
+                event = self._in_flight.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = threading.Event()
+                    self._in_flight[key] = event
+                    break
+            # Somebody else is computing this key; check again once they're done
+            event.wait()
+
+        try:
+            value = compute()
+            self.put(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            event.set()
+
+    def _put_locked(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class PersistentLRUCache(LRUCache):
+    """
+    An LRUCache that is also written through to an append-only JSON lines file,
+    so its entries survive process restarts. Keys must be tuples of JSON
+    serializable values, and values must be JSON serializable.
+
+    The file is read lazily on first access, and compacted down to the live
+    entries once it grows well past the size cap. Several processes can share
+    the file: writes to it hold a lock on a file next to it, and compaction
+    keeps entries other processes have appended.
+    """
+
+    def __init__(self, max_size, path):
+        super().__init__(max_size)
+        self.path = path
+        self._loaded = path is None
+        self._file_lines = 0
+
+    def get(self, key, default=None):
+        self._load()
+        return super().get(key, default)
+
+    def get_or_compute(self, key, compute):
+        self._load()
+        return super().get_or_compute(key, compute)
+
+    def put(self, key, value):
+        self._load()
+        with self._lock:
+            self._put_locked(key, value)
+            if self.path:
+                self._append_locked(key, value)
+
+    def _load(self):
+        if self._loaded:
+            return
+
+        with self._lock:
+            if self._loaded:
+                return
+            for key, value in self._read_file():
+                self._put_locked(key, value)
+                self._file_lines += 1
+
+            if self._file_lines > 2 * self.max_size:
+                self._compact_locked()
+            self._loaded = True
+
+    def _read_file(self):
+        """
+        Yields the (key, value) entries in the file, oldest first
+        """
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        continue  # skip partially written lines
+                    yield tuple(key), value
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _append_locked(self, key, value):
+        try:
+            with self._file_lock():
+                with open(self.path, "a") as f:
+                    f.write(json.dumps([list(key), value]) + "\n")
+            self._file_lines += 1
+        except OSError:
+            # Persistence is best effort; the in-memory cache still works
+            return
+
+        if self._file_lines > 2 * self.max_size:
+            self._compact_locked()
+
+    def _compact_locked(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with self._file_lock():
+                # Re-read the file rather than writing out our own entries, since
+                # other processes may have appended entries we don't have
+                entries = OrderedDict()
+                for key, value in self._read_file():
+                    entries.pop(key, None)
+                    entries[key] = value
+                    if len(entries) > self.max_size:
+                        entries.popitem(last=False)
+
+                with open(tmp_path, "w") as f:
+                    for key, value in entries.items():
+                        f.write(json.dumps([list(key), value]) + "\n")
+                os.replace(tmp_path, self.path)
+            self._file_lines = len(entries)
+        except OSError:
+            pass
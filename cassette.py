@@ -0,0 +1,75 @@
+import hashlib
+import json
+import math
+import random
+import threading
+
+from cache import PersistentLRUCache
+from state import llm_config
+
+# Cassettes of recorded LLM responses by file path. Each entry is keyed by a hash
+# of the prompts and inference parameters, and holds the response and how long
+# the provider took to give it.
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def get_cassette(path=None):
+    """
+    Returns the cassette at the given path, or the configured one
+    """
+    path = path or llm_config["cassette"]["path"]
+    with _cassettes_lock:
+        if path not in _cassettes:
+            _cassettes[path] = PersistentLRUCache(llm_config["cassette"]["max_size"], path)
+        return _cassettes[path]
+
+
+def cassette_key(system_prompt, user_prompt):
+    params = {
+        "temp": llm_config["config"]["temp"],
+        "max_tokens": llm_config["config"]["max_tokens"],
+    }
+    request = json.dumps([system_prompt, user_prompt, params], sort_keys=True)
+    return (hashlib.sha256(request.encode("utf-8")).hexdigest(),)
+
+
+def record_llm_response(system_prompt, user_prompt, response, latency):
+    """
+    Adds a response from a live LLM provider to the cassette
+    """
+    get_cassette().put(
+        cassette_key(system_prompt, user_prompt),
+        {
+            "system_prompt": system_prompt,
+            "user_prompt": user_prompt,
+            "response": response,
+            "latency": latency,
+        },
+    )
+
+
+def replay_llm_response(system_prompt, user_prompt):
+    """
+    Returns the recorded response for the prompts, and how many seconds to
+    wait before giving it to simulate the provider's latency
+    """
+    entry = get_cassette().get(cassette_key(system_prompt, user_prompt))
+    if entry is None:
+        raise Exception("No recorded LLM response for this prompt in the cassette")
+    return entry["response"], _replay_latency(entry)
+
+
+def _replay_latency(entry):
+    mode = llm_config["cassette"]["replay_latency"]
+    if mode == "none":
+        return 0.0
+    elif mode == "recorded":
+        return entry["latency"]
+    elif mode == "lognormal":
+        return random.lognormvariate(
+            math.log(llm_config["cassette"]["replay_latency_median"]),
+            llm_config["cassette"]["replay_latency_sigma"],
+        )
+    else:
+        raise Exception(f"Unsupported replay latency: {mode}")
@@ -0,0 +1,303 @@
+import os
+import struct
+import threading
+import time
+import weakref
+from array import array
+
+from state import config
+
+# Each log file has a sidecar index, so readers can find lines without scanning
+# the log. The index is a uint64 header with the number of the log's first line
+# (counting across rotated logs), then the uint64 byte offset of the end of each line.
+INDEX_SUFFIX = ".idx"
+_INDEX_ENTRY = struct.Struct("<Q")
+
+# Writers with buffered entries, flushed by the background thread if enabled
+_writers = weakref.WeakSet()
+_writers_lock = threading.Lock()
+_flush_thread = None
+
+
+class DebugLogWriter:
+    """
+    Buffers debug log entries for one session in memory, and appends them to
+    the log file in one go when flushed, keeping the file open between flushes.
+    Keeps the log's line index up to date, and rotates the log once it gets
+    too big: the current log becomes path.1, the previous path.1 becomes path.2, etc.
+
+    on_flush is called after each flush that wrote something, e.g. to commit
+    the volume the log is on.
+    """
+
+    def __init__(self, path, on_flush=None):
+        self.path = path
+        self.on_flush = on_flush
+        self._buffer = []
+        self._file = None
+        self._index_file = None
+        self._size = 0  # bytes in the current log file
+        self._line_end = 0  # byte offset of the end of its last complete line
+        self._line_count = 0  # number of the next line, counting across rotated logs
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+        _start_flush_thread()
+        with _writers_lock:
+            _writers.add(self)
+
+    def write(self, output):
+        with self._lock:
+            self._buffer.append(output)
+
+        flush_interval = config["logging"]["flush_interval"]
+        if (
+            flush_interval
+            and not config["logging"]["background_flush"]
+            and time.monotonic() - self._last_flush >= flush_interval
+        ):
+            self.flush()
+
+    def flush(self, close=False):
+        """
+        Writes out everything buffered so far. Closing the file afterwards
+        lets other processes (or volume reloads) see a consistent file.
+        """
+        with self._lock:
+            output = "".join(self._buffer)
+            self._buffer = []
+            self._last_flush = time.monotonic()
+
+            if output:
+                self._write(output.encode("utf-8"))
+            if close and self._file is not None:
+                self._file.close()
+                self._index_file.close()
+                self._file = self._index_file = None
+
+        if output and self.on_flush:
+            self.on_flush()
+
+    def close(self):
+        self.flush(close=True)
+        with _writers_lock:
+            _writers.discard(self)
+
+    def _write(self, data):
+        if self._file is None:
+            self._open()
+
+        # Only rotate in between lines, so no line is split across files
+        if (
+            self._size
+            and self._size == self._line_end
+            and self._size + len(data) > config["logging"]["max_log_size"]
+        ):
+            self._file.close()
+            self._index_file.close()
+            _rotate_log(self.path)
+            self._open()
+
+        line_ends = []
+        pos = data.find(b"\n")
+        while pos != -1:
+            line_ends.append(self._size + pos + 1)
+            pos = data.find(b"\n", pos + 1)
+
+        self._file.write(data)
+        self._file.flush()
+        if line_ends:
+            self._index_file.write(array("Q", line_ends).tobytes())
+            self._index_file.flush()
+            self._line_end = line_ends[-1]
+        self._size += len(data)
+        self._line_count += len(line_ends)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "ab")
+        self._size = self._file.tell()
+
+        part = _LogPart(self.path)
+        if not part.is_indexed or part.line_end(part.count - 1) > self._size:
+            # Logs from before indexing, or whose index is ahead of the log
+            start = self._line_count or _next_line_after(self.path + ".1")
+            part = _index_log(self.path, start)
+        elif part.line_end(part.count - 1) < self._size:
+            # Lines may have been written after the index was last updated,
+            # e.g. by a process that died in between
+            part = _index_log_tail(self.path, part)
+        self._line_count = part.start + part.count
+        self._line_end = part.line_end(part.count - 1)
+        self._index_file = open(self.path + INDEX_SUFFIX, "ab")
+
+
+class _LogPart:
+    """
+    One log file (current or rotated), and where its lines are according to its index
+    """
+
+    def __init__(self, path, start=0, line_ends=None):
+        self.path = path
+        self.start = start
+        self.is_indexed = os.path.exists(path + INDEX_SUFFIX)
+        self._line_ends = line_ends
+
+        if line_ends is not None:
+            self.count = len(line_ends)
+        elif self.is_indexed:
+            with open(path + INDEX_SUFFIX, "rb") as f:
+                header = f.read(_INDEX_ENTRY.size)
+            self.start = _INDEX_ENTRY.unpack(header)[0] if header else start
+            self.count = max(os.path.getsize(path + INDEX_SUFFIX) // _INDEX_ENTRY.size - 1, 0)
+        else:
+            self.count = 0
+
+    def line_end(self, line):
+        """
+        Returns the byte offset of the end of the given line in this file (0 for line -1)
+        """
+        if line < 0:
+            return 0
+        if self._line_ends is not None:
+            return self._line_ends[line]
+        with open(self.path + INDEX_SUFFIX, "rb") as f:
+            f.seek(_INDEX_ENTRY.size * (line + 1))
+            return _INDEX_ENTRY.unpack(f.read(_INDEX_ENTRY.size))[0]
+
+    def read_lines(self, first, last):
+        """
+        Returns the bytes of lines first to last (exclusive, counting across
+        rotated logs) that are in this file
+        """
+        first = max(first, self.start) - self.start
+        last = min(last, self.start + self.count) - self.start
+        if first >= last:
+            return b""
+        begin = self.line_end(first - 1)
+        with open(self.path, "rb") as f:
+            f.seek(begin)
+            return f.read(self.line_end(last - 1) - begin)
+
+
+def read_log(path, since=None, before=None, count=250):
+    """
+    Reads lines of a debug log using its index, with lines numbered across
+    rotated logs:
+    - since: up to count lines starting at that line, for polling new output
+    - before: up to count lines ending just before that line, for scrolling back
+    - otherwise, the last count lines
+
+    Returns a dict with the text as "log", and the numbers of the first line
+    returned and of the line after the last one as "start" and "end", to use
+    as cursors for the next read. Returns None if there's no log.
+    """
+    parts = [
+        _log_part_for_reading(path + f".{n}")
+        for n in range(config["logging"]["max_log_parts"], 0, -1)
+    ] + [_log_part_for_reading(path)]
+    parts = [part for part in parts if part is not None]
+    if not parts:
+        return None
+
+    first_line = parts[0].start
+    end_line = parts[-1].start + parts[-1].count
+    if since is not None:
+        first = min(max(since, first_line), end_line)
+        last = min(first + count, end_line)
+    elif before is not None:
+        last = min(max(before, first_line), end_line)
+        first = max(last - count, first_line)
+    else:
+        last = end_line
+        first = max(last - count, first_line)
+
+    text = b"".join(part.read_lines(first, last) for part in parts)
+    return {"log": text.decode("utf-8", errors="replace"), "start": first, "end": last}
+
+
+def _log_part_for_reading(path):
+    if not os.path.exists(path):
+        return None
+    part = _LogPart(path)
+    if not part.is_indexed:
+        # Logs from before indexing get indexed in memory
+        part = _LogPart(path, line_ends=_scan_line_ends(path))
+    return part
+
+
+def _scan_line_ends(path, offset=0):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    line_ends = []
+    pos = data.find(b"\n")
+    while pos != -1:
+        line_ends.append(offset + pos + 1)
+        pos = data.find(b"\n", pos + 1)
+    return line_ends
+
+
+def _index_log(path, start):
+    line_ends = _scan_line_ends(path)
+    with open(path + INDEX_SUFFIX, "wb") as f:
+        f.write(_INDEX_ENTRY.pack(start))
+        f.write(array("Q", line_ends).tobytes())
+    return _LogPart(path, start, line_ends)
+
+
+def _index_log_tail(path, part):
+    line_ends = _scan_line_ends(path, part.line_end(part.count - 1))
+    if not line_ends:
+        return part
+    with open(path + INDEX_SUFFIX, "r+b") as f:
+        # Drops any entry that was only partly written
+        f.truncate(_INDEX_ENTRY.size * (part.count + 1))
+        f.seek(0, os.SEEK_END)
+        f.write(array("Q", line_ends).tobytes())
+    return _LogPart(path)
+
+
+def _next_line_after(path):
+    if not os.path.exists(path + INDEX_SUFFIX):
+        return 0
+    part = _LogPart(path)
+    return part.start + part.count
+
+
+def _rotate_log(path):
+    max_log_parts = config["logging"]["max_log_parts"]
+    for suffix in ("", INDEX_SUFFIX):
+        oldest = f"{path}.{max_log_parts}{suffix}"
+        if max_log_parts and os.path.exists(oldest):
+            os.remove(oldest)
+        for n in range(max_log_parts - 1, 0, -1):
+            if os.path.exists(f"{path}.{n}{suffix}"):
+                os.replace(f"{path}.{n}{suffix}", f"{path}.{n + 1}{suffix}")
+        if max_log_parts:
+            os.replace(path + suffix, f"{path}.1{suffix}")
+        else:
+            os.remove(path + suffix)
+
+
+def _start_flush_thread():
+    global _flush_thread
+    if not config["logging"]["background_flush"] or not config["logging"]["flush_interval"]:
+        return
+    with _writers_lock:
+        if _flush_thread is None:
+            _flush_thread = threading.Thread(target=_flush_periodically, daemon=True)
+            _flush_thread.start()
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(config["logging"]["flush_interval"])
+        with _writers_lock:
+            writers = list(_writers)
+        for writer in writers:
+            try:
+                writer.flush()
+            except Exception as e:
+                # Keep flushing the other sessions' logs
+                print(f"Unable to flush debug log {writer.path}: {e}")
@@ -15,27 +15,40 @@ from game import (
     try_to_fix_parser_error,
     is_parser_error,
     add_recent_gamelog_and_current_room_to_llm_prompt,
+    get_current_room,
 )
 from utils import (
     write_to_debug_log,
     concat_current_llm_prompt,
+    add_static_prompt_prefix,
     get_llm_response_for_current_prompt,
+    get_llm_response_stream_for_current_prompt,
+    take_current_llm_prompt,
+    make_llm_inference_batch,
+    flush_debug_log,
 )
 from state import (
     config,
     get_current_state,
 )
+from tracing import add_span, span
+from prefetch import cancel_prefetch, start_prefetch, take_prefetched
+from valid_actions import precompute_valid_actions
 
 
 def init_rewrites(game_init_text):
     """
     Performs first rewrite of the initial game response
     """
-    state = get_current_state()
-    concat_current_llm_prompt(config["style"]["tone_" + state.tone])
-    concat_current_llm_prompt(config["style"]["length"])
-    concat_current_llm_prompt(config["style"]["formatting"])
-    concat_current_llm_prompt(config["style"]["caveat"])
+    prepare_init_rewrite_prompt(game_init_text)
+    return get_llm_response_for_current_prompt()
+
+
+def prepare_init_rewrite_prompt(game_init_text):
+    """
+    Builds the current LLM prompt for rewriting the initial game response
+    """
+    add_static_prompt_prefix("init")
 
     if game_init_text[-1] == ">":  # remove input prompt, if there
         game_init_text = game_init_text[:-1]
@@ -43,34 +56,99 @@ def init_rewrites(game_init_text):
 
     startup_prompt = config["init"]["startup"].replace("{{{startup_text}}}", game_init_text)
     concat_current_llm_prompt(startup_prompt)
-    return get_llm_response_for_current_prompt()
 
 
-def rewrite_response(command, response):
+def rewrite_response(command, response, current_room=None):
     """
     Rewriting game response after given an user command.
     User command should have gone through parser error check.
+    Looks up the current room unless it's given.
+    """
+    if not response:
+        return response
+
+    input = prepare_rewrite_prompt(command, response, current_room)
+    llm_response = get_llm_response_for_current_prompt()
+
+    if input == True:
+        llm_response = llm_response + "\n\n>"
+    return llm_response
+
+
+def rewrite_response_stream(command, response, current_room=None):
+    """
+    Like rewrite_response(), but yields the rewritten response in pieces
+    as the LLM generates it.
+    """
+    if not response:
+        return
+
+    input = prepare_rewrite_prompt(command, response, current_room)
+    yield from get_llm_response_stream_for_current_prompt()
+
+    if input == True:
+        yield "\n\n>"
+
+
+def prepare_rewrite(command, response, current_room=None):
+    """
+    Like rewrite_response(), but only builds the LLM prompt, so that several
+    rewrites can be sent together by rewrite_prepared()
     """
-    input = False
     if not response:
         return response
 
+    input = prepare_rewrite_prompt(command, response, current_room)
+    return {"prompt": take_current_llm_prompt(), "input": input}
+
+
+def rewrite_prepared(rewrites):
+    """
+    Sends the LLM prompts of rewrites from prepare_rewrite() all in one batch,
+    returning the rewritten responses in the same order. Anything else in the
+    list is taken to be rewritten already, and returned as it is.
+    """
+    pending = [rewrite for rewrite in rewrites if isinstance(rewrite, dict)]
+    llm_responses = make_llm_inference_batch(
+        [rewrite["prompt"][:2] for rewrite in pending],
+        # Every prompt starts with the same instructions for the session's tone
+        min([rewrite["prompt"][2] for rewrite in pending], default=0),
+    )
+    for rewrite, llm_response in zip(pending, llm_responses):
+        if rewrite["input"] == True:
+            llm_response = llm_response + "\n\n>"
+        rewrite["llm_response"] = llm_response
+
+    return [
+        rewrite["llm_response"] if isinstance(rewrite, dict) else rewrite
+        for rewrite in rewrites
+    ]
+
+
+def prepare_rewrite_prompt(command, response, current_room=None, is_error=None):
+    """
+    Builds the current LLM prompt for rewriting a game response.
+    Looks up the current room and whether the response is a parser error,
+    unless they're given.
+
+    Returns True if the response ended with an input prompt, which the
+    rewritten response should end with too.
+    """
+    input = False
     if response[-1] == ">":  # remove input prompt, if there
         response = response[:-1]
         input = True
     command = command.strip()
     response = response.strip()
 
-    state = get_current_state()
-    concat_current_llm_prompt(config["style"]["tone_" + state.tone])
-    concat_current_llm_prompt(config["style"]["length"])
-    concat_current_llm_prompt(config["style"]["formatting"])
-    concat_current_llm_prompt(config["style"]["caveat"])
-    add_recent_gamelog_and_current_room_to_llm_prompt()
+    add_static_prompt_prefix("rewrite")
+    add_recent_gamelog_and_current_room_to_llm_prompt(current_room)
 
     # We should have tried to fix parser error by this point.
     # If we're at an unfixable error, just make stuff up
-    if is_parser_error(command, response):
+    if is_error is None:
+        is_error = is_parser_error(command, response)
+    if is_error:
         concat_current_llm_prompt(config["errors"]["generic"])
 
     # Perform LLM rewrite.
@@ -80,62 +158,226 @@ def rewrite_response(command, response):
     )
     concat_current_llm_prompt(prompt)
     concat_current_llm_prompt(config["responses"]["suffix"])
-    llm_response = get_llm_response_for_current_prompt()
+    return input
 
-    if input == True:
-        llm_response = llm_response + "\n\n>"
-    return llm_response
 
+def start_new_game(defer_rewrite=False):
+    """
+    Starts the game, returning the same as process_input().
 
-def start_new_game():
+    With defer_rewrite, the rewritten response is left to be done by
+    rewrite_prepared(), and its place taken by the prepared rewrite.
+    """
     state = get_current_state()
+    start = time.perf_counter()
 
     # Initial response, rewritten with LLM
-    game_response, info = state.env.reset()
-    add_to_game_log(game_response, is_command=False)
-
+    game_response = start_game_turn()
     if state.tone == "none":
         llm_response = game_response
+    elif defer_rewrite:
+        prepare_init_rewrite_prompt(game_response)
+        llm_response = {"prompt": take_current_llm_prompt(), "input": False}
     else:
-        llm_response = init_rewrites(game_response)
+        with span("rewrite"):
+            llm_response = init_rewrites(game_response)
 
+    finish_game_turn(start)
     return None, None, game_response, llm_response, False
 
 
-def process_input(input_command):
+def start_game_turn():
+    """
+    Steps shared by every start of a game before the rewrite: resets the game,
+    and logs the initial game response, which it returns
+    """
+    state = get_current_state()
+
+    # Environments from the pool have already been reset for us
+    if state.initial_game_response:
+        game_response, info = state.initial_game_response
+        state.initial_game_response = None
+    else:
+        game_response, info = state.env.reset()
+    add_to_game_log(game_response, is_command=False)
+    return game_response
+
+
+def finish_game_turn(start):
+    """
+    Steps shared by every start of a game after the rewrite: records its span,
+    and gets ready for the first command in the background
+    """
+    state = get_current_state()
+    flush_debug_log()
+    add_span("start_game", start)
+    precompute_valid_actions(state.env, state.game_path)
+    start_prefetch()
+
+
+def run_command(input_command):
+    """
+    Runs the user command in the game, first trying to fix it if the game
+    doesn't understand it.
+
+    Returns the command actually given to the game, the game response,
+    and whether the game is over.
+    """
     state = get_current_state()
 
     write_to_debug_log(f"=== User Input ===\n{input_command}\n\n")
 
-    temp_game_state = state.env.get_state()
-    game_response, _, is_game_over, ___ = state.env.step(input_command)
+    with span("env.get_state"):
+        temp_game_state = state.env.get_state()
+    with span("env.step"):
+        game_response, _, is_game_over, ___ = state.env.step(input_command)
 
     write_to_debug_log(f"=== Game Response ===\n{game_response}\n\n")
 
+    with span("is_parser_error"):
+        is_error = is_parser_error(input_command, game_response)
+
     # If we detected parse error, try LLM rewrite
-    if is_parser_error(input_command, game_response):
+    if is_error:
         write_to_debug_log("UNRECOGNIZED COMMAND: " + input_command + "\n\n")
 
         # First, we roll back to the state before error, just in case
         # the failed command changes game state.
-        state.env.set_state(temp_game_state)
+        with span("env.set_state"):
+            state.env.set_state(temp_game_state)
 
-        game_command = try_to_fix_parser_error(input_command, game_response)
+        with span("fix_parser_error"):
+            game_command = try_to_fix_parser_error(input_command, game_response)
         write_to_debug_log(f"=== Alt. User Input ===\n{game_command}\n\n")
 
-        game_response, _, is_game_over, ___ = state.env.step(game_command)
+        with span("env.step"):
+            game_response, _, is_game_over, ___ = state.env.step(game_command)
         write_to_debug_log(f"=== Alt. Game Response===\n{game_response}\n\n")
     else:
         game_command = input_command
 
-    # Finally, perform LLM rewrite for the game response
-    # Note that we're writing with the original user input
-    if state.tone == "none":
-        llm_response = game_response
-    else:
-        llm_response = rewrite_response(input_command, game_response)
+    return game_command, game_response, is_game_over
+
+
+def start_turn(input_command):
+    """
+    Steps shared by every turn before the command is run: stops any prefetch
+    still running for the session, and picks up what it worked out for this
+    command, if anything, resuming the game from there.
+
+    Returns the prefetched result, or None if the command still needs running.
+    """
+    state = get_current_state()
+    cancel_prefetch()
 
+    prefetched = take_prefetched(input_command)
+    if prefetched:
+        # Worked out in the background while the player was typing
+        write_to_debug_log(f"=== User Input (prefetched) ===\n{input_command}\n\n")
+        state.env.set_state(prefetched["game_state"])
+        write_to_debug_log(f"=== Game Response ===\n{prefetched['game_response']}\n\n")
+    return prefetched
+
+
+def finish_turn(start, game_command, game_response, is_game_over, prefetched=None):
+    """
+    Steps shared by every turn once the command has run: logs it, records the
+    turn's span, and gets ready for the next command in the background
+    """
+    state = get_current_state()
     add_to_game_log(game_command, is_command=True)
     add_to_game_log(game_response, is_command=False)
 
+    flush_debug_log()
+    add_span("turn", start, prefetched=bool(prefetched))
+    if not is_game_over:
+        precompute_valid_actions(state.env, state.game_path)
+        start_prefetch()
+
+
+def process_input(input_command, defer_rewrite=False):
+    """
+    Runs one turn for the user command, returning the command, the command
+    actually given to the game, the game response, the rewritten response,
+    and whether the game is over.
+
+    With defer_rewrite, the rewritten response is left to be done by
+    rewrite_prepared(), and its place taken by the prepared rewrite.
+    """
+    state = get_current_state()
+    start = time.perf_counter()
+
+    prefetched = start_turn(input_command)
+    if prefetched:
+        game_command = prefetched["game_command"]
+        game_response = prefetched["game_response"]
+        is_game_over = prefetched["is_game_over"]
+        llm_response = prefetched["llm_response"]
+    else:
+        game_command, game_response, is_game_over = run_command(input_command)
+
+        # Finally, perform LLM rewrite for the game response
+        # Note that we're writing with the original user input
+        if state.tone == "none":
+            llm_response = game_response
+        elif defer_rewrite:
+            llm_response = prepare_rewrite(input_command, game_response)
+        else:
+            # The game doesn't change while rewriting, so look at the room just once
+            current_room = get_current_room()
+            with span("rewrite"):
+                llm_response = rewrite_response(input_command, game_response, current_room)
+
+    finish_turn(start, game_command, game_response, is_game_over, prefetched)
     return input_command, game_command, game_response, llm_response, is_game_over
+
+
+def process_input_stream(input_command):
+    """
+    Like process_input(), but a generator that yields the game's own response
+    as soon as it's known, and then the LLM rewrite as it's generated.
+
+    Yields dicts whose "type" is one of:
+    - "game_response": with input_command, game_command, game_response and is_game_over
+    - "llm_response": with the next piece of the rewritten response as "text"
+    - "done": with the complete rewritten response as "llm_response"
+    """
+    state = get_current_state()
+    start = time.perf_counter()
+
+    prefetched = start_turn(input_command)
+    if prefetched:
+        game_command = prefetched["game_command"]
+        game_response = prefetched["game_response"]
+        is_game_over = prefetched["is_game_over"]
+    else:
+        game_command, game_response, is_game_over = run_command(input_command)
+    yield {
+        "type": "game_response",
+        "input_command": input_command,
+        "game_command": game_command,
+        "game_response": game_response,
+        "is_game_over": is_game_over,
+    }
+
+    segments = []
+    try:
+        if prefetched:
+            segments.append(prefetched["llm_response"])
+            yield {"type": "llm_response", "text": prefetched["llm_response"]}
+        elif state.tone == "none":
+            segments.append(game_response)
+            yield {"type": "llm_response", "text": game_response}
+        else:
+            current_room = get_current_room()
+            with span("rewrite"):
+                for segment in rewrite_response_stream(
+                    input_command, game_response, current_room
+                ):
+                    segments.append(segment)
+                    yield {"type": "llm_response", "text": segment}
+    finally:
+        # The command has run even if the rewrite was cut short, so keep the log in sync
+        finish_turn(start, game_command, game_response, is_game_over, prefetched)
+
+    yield {"type": "done", "llm_response": "".join(segments)}
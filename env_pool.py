@@ -0,0 +1,133 @@
+import threading
+from collections import deque
+
+import jericho
+import jericho.jericho
+
+from state import config
+
+# Story data loaded once per game path and shared by every environment for
+# that game: (rom bytes, bindings, action generator, is fully supported).
+# Building the bindings and action generator is most of the cost of a FrotzEnv.
+_stories = {}
+_stories_lock = threading.Lock()
+
+# Environments that have already been reset and are ready for a new game, per game path,
+# as (env, initial game response, info)
+_env_pools = {}
+_env_pools_lock = threading.Lock()
+_refilling = set()  # game paths with a refill thread running
+
+# Each thread's own environments, per game path, for stepping games without
+# touching any session's environment
+_thread_envs = threading.local()
+
+
+def get_story_bytes(game_path):
+    """
+    Returns the contents of the story file, read from disk only once per process
+    """
+    return _get_story(game_path)[0]
+
+
+def create_env(game_path):
+    """
+    Creates a Frotz environment for the game, reusing the story data loaded
+    by earlier environments instead of parsing the story file again.
+    """
+    rom, bindings, act_gen, is_fully_supported = _get_story(game_path)
+
+    # NOTE: This mirrors FrotzEnv.__init__, but seeds the environment's own story
+    # cache so load() skips reading the file and rebuilding the bindings.
+    env = jericho.FrotzEnv.__new__(jericho.FrotzEnv)
+    env._cache = {game_path: (rom, bindings, act_gen)}
+    env.frotz_lib = jericho.jericho._load_frotz_lib()
+    env._bindings = None
+    env.is_fully_supported = is_fully_supported
+    env.load(game_path)
+    return env
+
+
+def get_thread_env(game_path):
+    """
+    Returns this thread's own Frotz environment for the game, created on first
+    use. Callers set it to the game state they need before using it.
+    """
+    envs = getattr(_thread_envs, "envs", None)
+    if envs is None:
+        envs = _thread_envs.envs = {}
+    if game_path not in envs:
+        envs[game_path] = create_env(game_path)
+    return envs[game_path]
+
+
+def take_env(game_path):
+    """
+    Takes a freshly reset environment for the game from the pool, creating
+    one if the pool is empty, and refills the pool in the background.
+
+    Returns the environment, along with the initial game response and info
+    that env.reset() returned for it.
+    """
+    with _env_pools_lock:
+        pool = _env_pools.setdefault(game_path, deque())
+        entry = pool.popleft() if pool else None
+
+    if entry is None:
+        entry = _create_reset_env(game_path)
+
+    _start_refill(game_path)
+    return entry
+
+
+def prewarm_env_pools(game_paths):
+    """
+    Fills the pools for the given games in the background
+    """
+    for game_path in game_paths:
+        _start_refill(game_path)
+
+
+def _get_story(game_path):
+    story = _stories.get(game_path)
+    if story is not None:
+        return story
+
+    with _stories_lock:
+        if game_path not in _stories:
+            env = jericho.FrotzEnv(game_path)
+            rom, bindings, act_gen = env._cache[game_path]
+            _stories[game_path] = (rom, bindings, act_gen, env.is_fully_supported)
+        return _stories[game_path]
+
+
+def _create_reset_env(game_path):
+    env = create_env(game_path)
+    game_response, info = env.reset()
+    return env, game_response, info
+
+
+def _start_refill(game_path):
+    with _env_pools_lock:
+        if game_path in _refilling:
+            return
+        if len(_env_pools.get(game_path, ())) >= config["sessions"]["env_pool_size"]:
+            return
+        _refilling.add(game_path)
+
+    threading.Thread(target=_refill, args=(game_path,), daemon=True).start()
+
+
+def _refill(game_path):
+    try:
+        while True:
+            with _env_pools_lock:
+                pool = _env_pools.setdefault(game_path, deque())
+                if len(pool) >= config["sessions"]["env_pool_size"]:
+                    return
+            entry = _create_reset_env(game_path)
+            with _env_pools_lock:
+                pool.append(entry)
+    finally:
+        with _env_pools_lock:
+            _refilling.discard(game_path)
@@ -39,6 +39,8 @@ const App = () => {
   const commandInputRef = useRef<null | HTMLInputElement>(null)
   const mounted = useRef(false)
   const pollLogId = useRef<ReturnType<typeof setInterval>>()
+  // Line of the debug log after the last one we've fetched
+  const logCursor = useRef<number>()
 
   const onMount = async () => {
     // Warm up LLM functions before player begin to start game
@@ -82,6 +84,8 @@ const App = () => {
 
   useEffect(() => {
     if (gameStateId) {
+      logCursor.current = undefined
+      setDebug('')
       tailLog()
     }
   }, [gameStateId])
@@ -194,11 +198,20 @@ Return only your response without any preface or introduction.`
         'Content-Type': 'application/json'
       },
       body: JSON.stringify({
-        game_state_id: gameStateId
+        game_state_id: gameStateId,
+        // Only fetch what's been logged since the last poll
+        since: logCursor.current
       })
     })
     const result = await response.json()
-    setDebug(result.log)
+    if (logCursor.current === undefined) {
+      setDebug(result.log)
+    } else {
+      setDebug(debug => (debug || '') + result.log)
+    }
+    if (result.end !== undefined) {
+      logCursor.current = result.end
+    }
   }
 
   const processCommand = async () => {
@@ -1,13 +1,56 @@
+import asyncio
+import contextvars
+import os
 import re
-import jericho
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
+from jericho.util import recognized
+
+from cache import LRUCache, PersistentLRUCache
+from env_pool import get_thread_env
 from state import get_current_state, config
 from utils import (
     write_to_debug_log,
     concat_current_llm_prompt,
+    mark_llm_prompt_cache_point,
     make_llm_inference,
     get_llm_response_for_current_prompt,
+    normalize_game_text,
+    uses_shared_caches,
+)
+from rewrites import lookup_rewrite, record_rewrite, forget_rewrite, rewrite_stats
+from vocab import get_parser_preamble, get_vocabulary
+from local_fix import local_fix_stats, match_valid_actions, rewrite_with_vocabulary
+from tracing import span
+from valid_actions import game_state_key, get_valid_actions, valid_actions_cache_stats
+
+# LLM parser error classifications, keyed by game, command and response.
+# Shared by all sessions, since the same response almost always gets the same answer.
+_parser_error_cache = PersistentLRUCache(
+    config["cache"]["parser_error_cache_size"],
+    (
+        os.path.join(config["cache"]["dir"], "parser_errors.jsonl")
+        if config["cache"]["parser_error_cache_on_disk"]
+        else None
+    ),
+)
+# The same for test providers, kept in memory only
+_test_parser_error_cache = LRUCache(config["cache"]["parser_error_cache_size"])
+
+# Worker threads for validating several candidate commands at once. Each thread
+# keeps its own Frotz environment per game, which it resets to the state under test.
+_validation_pool = ThreadPoolExecutor(
+    max_workers=config["errors"]["validation_workers"],
+    thread_name_prefix="validate",
+)
+
+# Descriptions of the player's location, keyed by game and game state fingerprint
+_room_cache = LRUCache(config["cache"]["room_cache_size"])
+
+
+PARSER_ERROR_SYSTEM_PROMPT = (
+    "You are helping a person play an interactive fiction and understand game commands."
 )
 
 
@@ -16,10 +59,52 @@ def is_parser_error(command, response):
     Check if the response is a parser error
     Returns True if it is, False otherwise
     """
+    known = _detect_parser_error(command, response)
+    if known is not None:
+        return known
+
+    # Then we use LLM for this, unless we've already classified this exchange
+    def classify():
+        result = make_llm_inference(
+            PARSER_ERROR_SYSTEM_PROMPT, _parser_error_prompt(command, response)
+        )
+        return result.lower().startswith("yes")
+
+    return _get_parser_error_cache().get_or_compute(
+        _parser_error_key(command, response), classify
+    )
+
+
+async def is_parser_error_async(command, response):
+    """
+    Like is_parser_error(), but awaits the LLM without blocking the event loop
+    """
+    known = _detect_parser_error(command, response)
+    if known is not None:
+        return known
+    return await asyncio.to_thread(is_parser_error, command, response)
+
+
+def peek_parser_error(command, response):
+    """
+    Check if the response is a parser error, without asking the LLM.
+    Returns True or False if we can tell, or None if the LLM needs to decide.
+    """
+    known = _detect_parser_error(command, response)
+    if known is not None:
+        return known
+    return _get_parser_error_cache().get(_parser_error_key(command, response))
+
+
+def _detect_parser_error(command, response):
+    """
+    Check if the response is a parser error without the LLM or its cached answers.
+    Returns True or False if we can tell, or None otherwise.
+    """
     state = get_current_state()
 
     # Use Jericho's logic to determine if the response is a parser error
-    if not jericho.util.recognized(response):
+    if not recognized(response):
         return True
 
     # For WebLLM, we can't run LLM inference on the backend
@@ -27,22 +112,34 @@ def is_parser_error(command, response):
     if state.llm_provider == "webllm":
         return False
 
-    # Then we use LLM for this
-    result = make_llm_inference(
-        "You are helping a person play an interactive fiction and understand game commands.",
+    return None
+
+
+def _get_parser_error_cache():
+    return _parser_error_cache if uses_shared_caches() else _test_parser_error_cache
+
+
+def _parser_error_key(command, response):
+    state = get_current_state()
+    return (
+        os.path.basename(state.game_path),
+        normalize_game_text(command),
+        normalize_game_text(response),
+    )
+
+
+def _parser_error_prompt(command, response):
+    return (
         config["errors"]["prompt"]
         .replace("{{{command}}}", command)
-        .replace("{{{response}}}", response),
+        .replace("{{{response}}}", response)
     )
-    if result.lower().startswith("yes"):
-        return True
-
-    return False
 
 
-def add_recent_gamelog_and_current_room_to_llm_prompt():
-    state = get_current_state()
-    current_room, gamelog = get_current_room_and_gamelog()
+def add_recent_gamelog_and_current_room_to_llm_prompt(current_room=None):
+    if current_room is None:
+        current_room = get_current_room()
+    gamelog = get_recent_gamelog()
     gamelog_text = config["responses"]["gamelog"].replace("{{{gamelog}}}", gamelog)
     concat_current_llm_prompt(gamelog_text)
 
@@ -61,68 +158,198 @@ def try_to_fix_parser_error(command, response):
     """
     state = get_current_state()
 
-    # get all the verbs for the game, and all the nouns accessible in the current room
-    verbs = [w for w in state.env.get_dictionary() if w.is_verb]
-    verbs = ", ".join([f'"{v.word}"' for v in verbs])
-    nouns = [w for w in state.env.get_dictionary() if w.is_noun]
-    nouns = ", ".join([f'"{n.word}"' for n in nouns])
-
-    # try several times to get the LLM to make a command that doesn't result in an parser error
-    preamble = config["errors"]["parser_preamble"].replace("{{{verbs}}}", verbs)
-    preamble = preamble.replace("{{{nouns}}}", nouns)
+    # If we've fixed this command before, check that the fix still works here
+    # and skip the LLM entirely
+    learned_command, known_bad_commands = lookup_rewrite(command)
+    if learned_command:
+        temp_game_state = state.env.get_state()
+        new_response, _, __, ___ = state.env.step(learned_command)
+        state.env.set_state(temp_game_state)
 
-    possible_actions = "\n".join(state.env.get_valid_actions())
+        if not is_parser_error(learned_command, new_response):
+            write_to_debug_log(f"LEARNED COMMAND REWRITE:\n{learned_command}\n\n")
+            rewrite_stats["hits"] += 1
+            return learned_command
+
+        forget_rewrite(command)
+        known_bad_commands = known_bad_commands + [learned_command]
+    rewrite_stats["misses"] += 1
+
+    # Most errors are easy fixes, like synonyms, typos and near misses of valid
+    # actions, which don't need the LLM
+    if config["errors"]["local_fix"]:
+        with span("local_fix"):
+            local_command = try_to_fix_parser_error_locally(command, response)
+        if local_command:
+            record_rewrite(command, fix=local_command)
+            return local_command
+
+    # get the verbs for the game, and the nouns accessible in the current room
+    with span("get_valid_actions"):
+        valid_actions = get_valid_actions(state.env, state.game_path)
+    preamble = get_parser_preamble(state.env, state.game_path, valid_actions)
+
+    possible_actions = "\n".join(valid_actions)
     possible_actions = config["errors"]["parser_rewrite_possible_actions"].replace(
         "{{{possible_actions}}}", possible_actions
     )
 
     error_response = config["responses"]["generic"].replace("{{{command}}}", command)
     error_response = error_response.replace("{{{response}}}", response)
-    tries = []
-    new_command = command
+    # Candidates are tested without changing the game, so the room stays the same for every try
+    current_room = get_current_room()
+    # Candidates that failed for other players are passed along as known failures
+    tries = list(known_bad_commands)
+    new_tries = []
+
+    # When asking for several candidates per LLM call, they're validated in parallel
+    candidate_count = config["errors"]["candidates"]
+    if candidate_count > 1:
+        parser_suffix = config["errors"]["parser_suffix_candidates"].replace(
+            "{{{count}}}", str(candidate_count)
+        )
+    else:
+        parser_suffix = config["errors"]["parser_suffix"]
 
+    # try several times to get the LLM to make a command that doesn't result in an parser error
     for i in range(config["errors"]["retries"]):
-        # Save current game state so we can roll back after
-        # trying alternative commands
-        temp_game_state = state.env.get_state()
+        with span("fix_parser_error.retry", attempt=i + 1):
+            add_recent_gamelog_and_current_room_to_llm_prompt(current_room)
+            concat_current_llm_prompt(error_response)
+            concat_current_llm_prompt(preamble)
+            concat_current_llm_prompt(possible_actions)
+            # Everything up to here is the same for every try
+            mark_llm_prompt_cache_point()
+
+            if len(tries) > 0:
+                failed_tries_prompt = "\n".join(tries)
+                failed_tries_prompt = config["errors"]["parser_rewrite_tries"].replace(
+                    "{{{alternative_commands}}}", failed_tries_prompt
+                )
+                concat_current_llm_prompt(failed_tries_prompt)
+            concat_current_llm_prompt(parser_suffix)
+
+            llm_response = get_llm_response_for_current_prompt()
+
+            # Attempt to parse out the newly suggested commands, best first
+            # If we can't find a suggested command, we give up and return original
+            new_commands = re.findall(r"<suggested_command>(.*?)</suggested_command>", llm_response, re.DOTALL)
+            new_commands = [c.strip() for c in new_commands if c.strip()]
+            new_commands = list(dict.fromkeys(new_commands))[:candidate_count]
+            if new_commands == []:
+                break
+            write_to_debug_log(
+                "LLM COMMAND REWRITING SUGGESTION:\n" + "\n".join(new_commands) + "\n\n"
+            )
 
-        add_recent_gamelog_and_current_room_to_llm_prompt()
-        concat_current_llm_prompt(error_response)
-        concat_current_llm_prompt(preamble)
-        concat_current_llm_prompt(possible_actions)
+            # Once we get a good command, use that to resume the game loop
+            with span("validate_candidates", count=len(new_commands)):
+                new_command, rejected_commands = validate_candidate_commands(new_commands)
+            tries.extend(rejected_commands)
+            new_tries.extend(rejected_commands)
+            if new_command:
+                record_rewrite(command, fix=new_command, bad=new_tries)
+                return new_command
+
+    if new_tries:
+        record_rewrite(command, bad=new_tries)
+    return command
 
-        if len(tries) > 0:
-            failed_tries_prompt = "\n".join(tries)
-            failed_tries_prompt = config["errors"]["parser_rewrite_tries"].replace(
-                "{{{alternative_commands}}}", failed_tries_prompt
-            )
-            concat_current_llm_prompt(failed_tries_prompt)
-        concat_current_llm_prompt(config["errors"]["parser_suffix"])
 
-        llm_response = get_llm_response_for_current_prompt()
+def try_to_fix_parser_error_locally(command, response):
+    """
+    Tries to fix the command without the LLM: first by rewriting it into words
+    in the game's dictionary, then by matching it to the most similar valid actions.
+    Each candidate is checked with a single step of the game.
+
+    Returns the fixed command, or None if the LLM is needed.
+    """
+    state = get_current_state()
 
-        # Attempt to parse out the newly suggested command
-        # If we can't find a suggested command, we give up and return original
-        new_command = re.findall(r"<suggested_command>(.*?)</suggested_command>", llm_response, re.DOTALL)
-        if new_command == []:
-            break
+    rewritten = rewrite_with_vocabulary(command, get_vocabulary(state.env, state.game_path))
+    if rewritten:
+        write_to_debug_log(f"LOCAL COMMAND REWRITING SUGGESTION:\n{rewritten}\n\n")
+        if _is_accepted_locally(rewritten, response):
+            local_fix_stats["hits"] += 1
+            return rewritten
+
+    with span("get_valid_actions"):
+        valid_actions = get_valid_actions(state.env, state.game_path)
+    matches = match_valid_actions(
+        rewritten or command,
+        [a for a in valid_actions if a != rewritten],
+        config["errors"]["local_fix_similarity"],
+        config["errors"]["local_fix_candidates"],
+    )
+    for match in matches:
+        write_to_debug_log(f"LOCAL COMMAND REWRITING SUGGESTION:\n{match}\n\n")
+        if _is_accepted_locally(match, response):
+            local_fix_stats["hits"] += 1
+            return match
 
-        new_command = new_command[0].strip()
-        write_to_debug_log(f"LLM COMMAND REWRITING SUGGESTION:\n{new_command}\n\n")
-        new_response, _, __, ___ = state.env.step(new_command)
-        write_to_debug_log(f"LLM COMMAND REWRITING RESPONSE:\n{new_response}\n\n")
+    local_fix_stats["misses"] += 1
+    return None
 
-        # Restore game state after testing new command
-        state.env.set_state(temp_game_state)
 
-        # Once we get a good command, use that to resume the game loop
-        if not is_parser_error(new_command, new_response):
-            command = new_command
-            break
+def _is_accepted_locally(candidate, error_response):
+    """
+    Steps the candidate command without changing the game, and checks that the
+    game understood it: the response mustn't be the same as the original error,
+    nor a parser error. Responses the parser error checks can't tell apart on
+    their own are classified in full, so a fix is only accepted when it's known
+    to work.
+    """
+    state = get_current_state()
+    game_state = state.env.get_state()
+    new_response, _, __, ___ = state.env.step(candidate)
+    state.env.set_state(game_state)
+    write_to_debug_log(f"LOCAL COMMAND REWRITING RESPONSE ({candidate}):\n{new_response}\n\n")
 
-        tries.append(new_command)
+    if normalize_game_text(new_response) == normalize_game_text(error_response):
+        return False
+    return not is_parser_error(candidate, new_response)
 
-    return command
+
+def validate_candidate_commands(candidates):
+    """
+    Tries each candidate command against the current game state, without
+    changing it. A single candidate is stepped on the session's environment;
+    several are stepped in parallel on per-thread copies of it.
+
+    Returns the highest ranked candidate the game accepts (or None), and the
+    candidates ranked above it that the game rejected.
+    """
+    state = get_current_state()
+    game_state = state.env.get_state()
+
+    def validate(candidate, env):
+        env.set_state(game_state)
+        new_response, _, __, ___ = env.step(candidate)
+        write_to_debug_log(
+            f"LLM COMMAND REWRITING RESPONSE ({candidate}):\n{new_response}\n\n"
+        )
+        return not is_parser_error(candidate, new_response)
+
+    if len(candidates) == 1:
+        accepted = [validate(candidates[0], state.env)]
+        # Restore game state after testing new command
+        state.env.set_state(game_state)
+    else:
+        # Each worker runs in a copy of our context, so it sees the same session
+        context = contextvars.copy_context()
+        accepted = _validation_pool.map(
+            lambda c: context.copy().run(validate, c, get_thread_env(state.game_path)),
+            candidates,
+        )
+
+    # Results come back in rank order, so we can stop at the first good one
+    # without waiting on lower ranked candidates
+    rejected = []
+    for candidate, is_accepted in zip(candidates, accepted):
+        if is_accepted:
+            return candidate, rejected
+        rejected.append(candidate)
+    return None, rejected
 
 
 def add_to_game_log(output, is_command=False):
@@ -142,25 +369,73 @@ def add_to_game_log(output, is_command=False):
     state.game_chatlog.append([is_command, output])
 
 
-def get_current_room_and_gamelog():
+def get_recent_gamelog():
     """
-    Get the most recent part of the game playlog as well as
-    the CURRENT room (a deviation from original implementation)
+    Get the most recent part of the game playlog
     """
     state = get_current_state()
 
     gamelog_count = config["responses"]["gamelog_count"]
     if gamelog_count == 0:
-        gamelog_count = len(state.game_chatlog)
+        gamelog = state.game_chatlog.recent()
     else:
-        gamelog_count = 2 * gamelog_count
-    gamelog = state.game_chatlog[-gamelog_count:]
-    gamelog_text = "\n".join([text for [b, text] in gamelog])
+        gamelog = state.game_chatlog.recent(2 * gamelog_count)
+    return "\n".join([text for [b, text] in gamelog])
 
-    # Use a normal look command to get current room info.
-    # We still save/restore state just in case looking changes the game.
-    backup_state = state.env.get_state()
-    current_room, _, _, _ = state.env.step("look")
-    state.env.set_state(backup_state)
 
-    return current_room, gamelog_text
+def get_game_state_key():
+    """
+    Returns a cheap fingerprint of the current game state, which changes
+    whenever anything in the Z-machine's memory does.
+    """
+    state = get_current_state()
+    return game_state_key(state.env, state.game_path)
+
+
+def get_current_room():
+    """
+    Get the description of the CURRENT room (a deviation from original implementation).
+    Descriptions are cached by game state, so we only step the emulator when
+    the game has changed since the last time we looked.
+    """
+    state = get_current_state()
+
+    def look():
+        # Use a normal look command to get current room info.
+        # We still save/restore state just in case looking changes the game.
+        with span("env.get_state"):
+            backup_state = state.env.get_state()
+        with span("env.step"):
+            current_room, _, _, _ = state.env.step("look")
+        with span("env.set_state"):
+            state.env.set_state(backup_state)
+        return current_room
+
+    with span("room_lookup"):
+        return _room_cache.get_or_compute(get_game_state_key(), look)
+
+
+def cache_stats():
+    """
+    Returns the hit and miss counts of the caches used while running turns
+    """
+    return {
+        "room_cache_hits": _room_cache.hits,
+        "room_cache_misses": _room_cache.misses,
+        "parser_error_cache_hits": _parser_error_cache.hits + _test_parser_error_cache.hits,
+        "parser_error_cache_misses": _parser_error_cache.misses
+        + _test_parser_error_cache.misses,
+        "learned_rewrite_hits": rewrite_stats["hits"],
+        "learned_rewrite_misses": rewrite_stats["misses"],
+        "local_fix_hits": local_fix_stats["hits"],
+        "local_fix_misses": local_fix_stats["misses"],
+        **valid_actions_cache_stats(),
+    }
+
+
+def get_current_room_and_gamelog():
+    """
+    Get the most recent part of the game playlog as well as
+    the CURRENT room (a deviation from original implementation)
+    """
+    return get_current_room(), get_recent_gamelog()
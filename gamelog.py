@@ -0,0 +1,102 @@
+from collections import deque
+
+
+class GameLog:
+    """
+    The log of game inputs and outputs, as [is_command, text] entries.
+
+    Entries are grouped into fixed-size segments. Once a segment fills up it's
+    sealed and never changes again, so it only needs to be persisted once; after
+    that it's dropped from memory, and loaded back only if full history is needed.
+    The most recent entries are always kept in memory for building prompts.
+    """
+
+    def __init__(self, segment_size, ring_size, length=0, tail=(), load_segment=None):
+        self.segment_size = segment_size
+        self.load_segment = load_segment  # index -> entries, for sealed segments already persisted
+
+        self._length = length
+        self._recent = deque(tail, maxlen=ring_size)
+        # Entries of the segment currently being filled
+        open_count = length % segment_size
+        self._open_segment = list(tail)[-open_count:] if open_count else []
+        # Sealed segments not yet persisted, by index
+        self._unsaved_segments = {}
+
+    def __len__(self):
+        return self._length
+
+    def append(self, entry):
+        self._open_segment.append(entry)
+        self._recent.append(entry)
+        self._length += 1
+
+        if len(self._open_segment) == self.segment_size:
+            self._unsaved_segments[self._length // self.segment_size - 1] = self._open_segment
+            self._open_segment = []
+
+    def recent(self, count=None):
+        """
+        Returns the last count entries, or all of them if count is None
+        """
+        if count is None or (count > len(self._recent) and self._length > len(self._recent)):
+            entries = self.entries()
+            return entries if count is None else entries[-count:]
+        return list(self._recent)[-count:] if count else []
+
+    def entries(self):
+        """
+        Returns the full log, loading any sealed segments no longer in memory
+        """
+        entries = []
+        for index in range(self._length // self.segment_size):
+            entries.extend(self.read_segment(index))
+        return entries + self._open_segment
+
+    def read_segment(self, index):
+        """
+        Returns the entries of a sealed segment, from memory if it hasn't been
+        persisted yet
+        """
+        segment = self._unsaved_segments.get(index)
+        if segment is None:
+            segment = self.load_segment(index)
+        return segment
+
+    def unsaved_segments(self):
+        """
+        Returns the sealed segments that haven't been persisted yet, by index
+        """
+        return dict(self._unsaved_segments)
+
+    def mark_saved(self, indexes):
+        for index in indexes:
+            self._unsaved_segments.pop(index, None)
+
+    def to_snapshot(self):
+        """
+        Returns what needs to go into a session snapshot: the length, and enough
+        of the latest entries to restore both the open segment and recent entries
+        """
+        # Both hold the latest entries, so the longer one covers the other
+        if len(self._open_segment) > len(self._recent):
+            tail = list(self._open_segment)
+        else:
+            tail = list(self._recent)
+        return {"length": self._length, "tail": tail}
+
+    @classmethod
+    def from_snapshot(cls, snapshot, segment_size, ring_size, load_segment=None):
+        if isinstance(snapshot, list):
+            # Snapshots from before the log was segmented hold every entry
+            game_log = cls(segment_size, ring_size)
+            for entry in snapshot:
+                game_log.append(entry)
+            return game_log
+        return cls(
+            segment_size,
+            ring_size,
+            length=snapshot["length"],
+            tail=snapshot["tail"],
+            load_segment=load_segment,
+        )
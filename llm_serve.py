@@ -70,6 +70,7 @@ class LLM:
             enforce_eager=False,  # capture the graph for faster inference, but slower cold starts
             disable_log_stats=True,  # disable logging so we can stream tokens
             disable_log_requests=True,
+            enable_prefix_caching=True,  # reuse the KV cache for the static start of prompts
         )
 
         # this can take some time!
@@ -124,6 +125,45 @@ class LLM:
             f" throughput = {num_tokens / duration_s:.0f} tokens/second on {GPU_CONFIG}.\n"
         )
 
+    @modal.method()
+    async def completion_batch(
+        self, messages_list, temp=0.75, max_tokens=2048, rep_penalty=1.1
+    ):
+        # Submits every conversation to the engine at once, so they're generated
+        # together in its continuous batches, and returns the completions in order
+        import asyncio
+        from vllm import SamplingParams
+        from vllm.utils import random_uuid
+
+        sampling_params = SamplingParams(
+            temperature=temp,
+            max_tokens=max_tokens,
+            repetition_penalty=rep_penalty,
+        )
+
+        async def generate(messages):
+            templated_chat = self.tokenizer.apply_chat_template(
+                messages, add_generation_prompt=True, tokenize=False
+            )
+            final_output = None
+            async for output in self.engine.generate(
+                templated_chat, sampling_params, random_uuid()
+            ):
+                final_output = output
+            return final_output.outputs[0]
+
+        start = time.monotonic_ns()
+        outputs = await asyncio.gather(*(generate(messages) for messages in messages_list))
+        duration_s = (time.monotonic_ns() - start) / 1e9
+
+        num_tokens = sum(len(output.token_ids) for output in outputs)
+        print(
+            f"\n################################################################"
+            f"\nGenerated {num_tokens} tokens for {len(outputs)} prompts from {MODEL_NAME} in {duration_s:.1f}s,"
+            f" throughput = {num_tokens / duration_s:.0f} tokens/second on {GPU_CONFIG}.\n"
+        )
+        return [output.text for output in outputs]
+
     @modal.exit()
     def stop_engine(self):
         # If there's more than one GPU, then:
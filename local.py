@@ -2,7 +2,7 @@ import argparse
 import curses
 from dotenv import load_dotenv
 
-from state import init_game_state, set_current_state
+from state import init_game_state, set_current_state, llm_config
 from splitscreen import SplitScreen
 import engine
 from utils import format_with_linebreaks
@@ -26,18 +26,36 @@ def show_output(input_command, game_command, game_response, llm_response):
 
     if game_command:
         splitscreen.output_text("> " + game_command, "> " + input_command)
+    splitscreen.begin_partial_output()
     splitscreen.output_text(game_response, llm_response)
 
 
+def show_partial_output(game_response, llm_response):
+    """
+    Redraws the latest game response with the rewrite streamed in so far
+    """
+    columns = splitscreen.col_width
+    game_response = format_with_linebreaks(game_response, columns)
+    llm_response = format_with_linebreaks(llm_response, columns)
+    splitscreen.output_partial_text(game_response, llm_response)
+
+
 def game_loop():
     is_game_over = False
     while not is_game_over:
-        # Attempt player command
+        # Attempt player command, showing the rewrite as it streams in
         input_command = splitscreen.get_command()
-        input_command, game_command, game_response, llm_response, is_game_over = (
-            engine.process_input(input_command)
-        )
-        show_output(input_command, game_command, game_response, llm_response)
+        llm_response = ""
+        for event in engine.process_input_stream(input_command):
+            if event["type"] == "game_response":
+                input_command = event["input_command"]
+                game_command = event["game_command"]
+                game_response = event["game_response"]
+                is_game_over = event["is_game_over"]
+                show_output(input_command, game_command, game_response, "")
+            elif event["type"] == "llm_response":
+                llm_response = llm_response + event["text"]
+                show_partial_output(game_response, llm_response)
 
 
 # Entry point
@@ -62,9 +80,14 @@ if __name__ == "__main__":
         "-l",
         "--llm",
         help="LLM provider",
-        choices=["together", "anthropic", "openai", "hosted"],
+        choices=["together", "anthropic", "openai", "hosted", "record", "replay", "stub"],
         default="anthropic",
     )
+    parser.add_argument(
+        "-c",
+        "--cassette",
+        help="Cassette file of LLM responses to record to or replay from",
+    )
     parser.add_argument(
         "-t",
         "--tone",
@@ -75,5 +98,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     load_dotenv()
+    if args.cassette:
+        llm_config["cassette"]["path"] = args.cassette
 
     curses.wrapper(main, args.game_path, args.llm, args.tone)
@@ -0,0 +1,222 @@
+import re
+import zlib
+
+import numpy as np
+
+# Counts of parser errors fixed without the LLM, and of those left for the LLM
+local_fix_stats = {"hits": 0, "misses": 0}
+
+# Words games ignore, dropped so they don't get in the way of matching
+ARTICLES = {"a", "an", "the", "some"}
+
+# Politeness and filler that players wrap commands in, which games don't understand.
+# Longer phrases go first, so they're stripped whole.
+POLITE_PREFIXES = [
+    ("i", "would", "like", "to"), ("i", "d", "like", "to"), ("i", "want", "to"),
+    ("i", "will"), ("i", "ll"), ("let", "s"), ("try", "to"),
+    ("could", "you"), ("can", "you"), ("would", "you"), ("will", "you"),
+    ("please",), ("kindly",), ("just",), ("now",), ("then",), ("lets",),
+]
+POLITE_SUFFIXES = [
+    ("right", "now"), ("for", "me"), ("thank", "you"), ("please",), ("now",), ("thanks",),
+]
+# Filler words dropped, rather than corrected to some other word, when the game doesn't know them
+FILLER_WORDS = {
+    "please", "kindly", "just", "really", "now", "would", "could", "like", "want",
+    "try", "thanks", "thank", "me",
+}
+
+DIRECTIONS = {
+    "north", "south", "east", "west", "northeast", "northwest", "southeast", "southwest",
+    "up", "down", "in", "out", "n", "s", "e", "w", "ne", "nw", "se", "sw", "u", "d",
+}
+MOVEMENT_VERBS = {"go", "walk", "run", "head", "move", "travel", "proceed", "stroll", "climb"}
+
+# Phrasings common in other games (and everyday English) for the standard verbs
+PHRASE_SYNONYMS = {
+    ("pick", "up"): ("take",),
+    ("take", "hold", "of"): ("take",),
+    ("look", "at"): ("examine",),
+    ("take", "look", "at"): ("examine",),
+    ("have", "look", "at"): ("examine",),
+    ("put", "down"): ("drop",),
+    ("set", "down"): ("drop",),
+    ("throw", "away"): ("drop",),
+    ("get", "rid", "of"): ("drop",),
+    ("look", "around"): ("look",),
+}
+
+# Standard verbs by their synonyms, used when the game doesn't know the synonym
+VERB_SYNONYMS = {
+    "grab": "take", "snatch": "take", "collect": "take", "fetch": "take", "obtain": "take",
+    "acquire": "take", "steal": "take",
+    "inspect": "examine", "check": "examine", "study": "examine", "observe": "examine",
+    "view": "examine", "describe": "examine", "investigate": "examine",
+    "shut": "close", "slam": "close",
+    "discard": "drop", "ditch": "drop", "dump": "drop",
+    "smash": "break", "shatter": "break",
+    "hit": "attack", "punch": "attack", "strike": "attack", "fight": "attack", "kill": "attack",
+    "consume": "eat", "devour": "eat",
+    "sip": "drink", "gulp": "drink",
+    "place": "put", "insert": "put",
+    "yank": "pull", "tug": "pull", "shove": "push", "press": "push",
+    "ignite": "light",
+    "peruse": "read", "skim": "read",
+    "speak": "say", "yell": "shout", "scream": "shout",
+    "don": "wear", "doff": "remove",
+    "inv": "inventory",
+}
+
+
+def rewrite_with_vocabulary(command, vocabulary):
+    """
+    Rewrites the command into words the game knows: common phrasings become the
+    standard verbs, synonyms the game doesn't know become ones it does, and words
+    that aren't in the game's dictionary are corrected to the closest ones that are.
+
+    Returns the rewritten command, or None if nothing could be improved.
+    """
+    words = vocabulary.words
+    length = vocabulary.word_length
+
+    def known(word):
+        return word[:length] in words
+
+    tokens = [t for t in re.findall(r"[a-z0-9]+", command.lower()) if t not in ARTICLES]
+    tokens = _strip_polite_phrases(tokens)
+    if not tokens:
+        return None
+
+    rewritten = []
+    for token in tokens:
+        if not known(token):
+            if token in FILLER_WORDS:
+                continue
+            synonym = VERB_SYNONYMS.get(token)
+            if synonym and known(synonym):
+                token = synonym
+            else:
+                token = closest_word(token, words, length) or token
+        rewritten.append(token)
+
+    # Phrasings are matched once typos are fixed, so "pikc up" is "take" too
+    for phrase, replacement in PHRASE_SYNONYMS.items():
+        if tuple(rewritten[: len(phrase)]) == phrase:
+            rewritten = list(replacement) + rewritten[len(phrase) :]
+            break
+
+    # "walk north" is just "north"
+    if len(rewritten) == 2 and rewritten[0] in MOVEMENT_VERBS and rewritten[1] in DIRECTIONS:
+        rewritten = rewritten[1:]
+
+    rewritten = " ".join(rewritten)
+    if rewritten == " ".join(command.lower().split()):
+        return None
+    return rewritten
+
+
+def _strip_polite_phrases(tokens):
+    """
+    Drops politeness wrapped around a command, like "please ...", "could you
+    ... for me" or "i would like to ...", however many layers of it there are
+    """
+    stripped = True
+    while stripped and tokens:
+        stripped = False
+        for phrase in POLITE_PREFIXES:
+            if len(tokens) > len(phrase) and tuple(tokens[: len(phrase)]) == phrase:
+                tokens, stripped = tokens[len(phrase) :], True
+        for phrase in POLITE_SUFFIXES:
+            if len(tokens) > len(phrase) and tuple(tokens[-len(phrase) :]) == phrase:
+                tokens, stripped = tokens[: -len(phrase)], True
+    return tokens
+
+
+def closest_word(word, words, length):
+    """
+    Returns the dictionary word closest to the given one, allowing one typo in
+    short words and two in longer ones, or None if there's no single closest word.
+    Dictionary words are only as long as the game stores them.
+    """
+    if len(word) < 4 or word.isdigit():
+        return None
+
+    word = word[:length]
+    max_distance = 1 if len(word) <= 5 else 2
+    best, best_distance, is_tie = None, max_distance + 1, False
+    for candidate in words:
+        if abs(len(candidate) - len(word)) > max_distance:
+            continue
+        # Limited to one more than the best so far, so ties can still be told apart
+        distance = edit_distance(word, candidate, best_distance + 1)
+        if distance < best_distance:
+            best, best_distance, is_tie = candidate, distance, False
+        elif distance == best_distance and best is not None and candidate != best:
+            is_tie = True
+
+    return None if is_tie else best
+
+
+def edit_distance(a, b, limit):
+    """
+    Returns the number of insertions, deletions, substitutions and swaps of
+    neighbouring letters needed to turn a into b, or limit if it's at least that
+    """
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) >= limit:
+            return limit
+        previous2, previous = previous, current
+    return min(previous[-1], limit)
+
+
+class NgramIndex:
+    """
+    Character n-gram vectors for a list of phrases, for finding the phrases
+    most like some text even when the words are misspelled or differ in form
+    """
+
+    def __init__(self, phrases, n=3, dimensions=2048):
+        self.phrases = list(phrases)
+        self.n = n
+        self.dimensions = dimensions
+        self.vectors = np.zeros((len(self.phrases), dimensions), dtype=np.float32)
+        for i, phrase in enumerate(self.phrases):
+            self.vectors[i] = self.vector(phrase)
+
+    def vector(self, text):
+        """
+        Returns the text's n-gram counts hashed into a fixed number of
+        dimensions, scaled to unit length
+        """
+        text = f" {' '.join(text.lower().split())} "
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for i in range(len(text) - self.n + 1):
+            vector[zlib.crc32(text[i : i + self.n].encode()) % self.dimensions] += 1
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def search(self, text, count=5):
+        """
+        Returns up to count (phrase, cosine similarity) pairs, most similar first
+        """
+        if not self.phrases:
+            return []
+        scores = self.vectors @ self.vector(text)
+        order = np.argsort(-scores, kind="stable")[:count]
+        return [(self.phrases[i], float(scores[i])) for i in order]
+
+
+def match_valid_actions(command, valid_actions, min_similarity, count):
+    """
+    Returns up to count of the valid actions most like the command, best
+    first, leaving out any less similar than min_similarity
+    """
+    matches = NgramIndex(valid_actions).search(command, count)
+    return [action for action, similarity in matches if similarity >= min_similarity]
@@ -0,0 +1,226 @@
+import contextvars
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache
+from env_pool import get_thread_env
+from state import GameState, config, get_current_state, new_game_log, set_current_state
+from tracing import increment_counter
+from utils import get_debug_log, normalize_game_text
+from valid_actions import game_state_key, get_valid_actions
+
+# Rewrites worked out ahead of time for commands the player is likely to enter
+# next, keyed by session, game state, game log length and command
+_prefetched = LRUCache(config["prefetch"]["cache_size"])
+
+# Background workers, each with its own Frotz environment per game, so
+# prefetching never touches a session's own environment
+_prefetch_pool = ThreadPoolExecutor(
+    max_workers=config["prefetch"]["workers"],
+    thread_name_prefix="prefetch",
+)
+
+# Cancel events for each session's pending prefetch, by session id
+_pending = {}
+_pending_lock = threading.Lock()
+
+prefetch_stats = {"hits": 0, "misses": 0, "prefetched": 0, "cancelled": 0}
+
+# Valid actions spell out directions, while players mostly abbreviate them
+_DIRECTION_ABBREVIATIONS = {
+    "north": "n",
+    "south": "s",
+    "east": "e",
+    "west": "w",
+    "northeast": "ne",
+    "northwest": "nw",
+    "southeast": "se",
+    "southwest": "sw",
+    "up": "u",
+    "down": "d",
+}
+
+
+def start_prefetch():
+    """
+    Starts working out, in the background, the responses and rewrites for the
+    commands the player is most likely to enter next. Called at the end of a turn.
+    """
+    state = get_current_state()
+    prefetch_config = config["prefetch"]
+    if not prefetch_config["enabled"] or state.tone == "none":
+        return
+
+    budget = prefetch_config["session_budget"] - state.prefetch_budget_used
+    count = min(prefetch_config["top_k"], budget)
+    if count <= 0:
+        return
+
+    # Everything the prefetch needs from the session is copied now, since the
+    # session carries on without waiting for it
+    snapshot = {
+        "game_state": state.env.get_state(),
+        "key": _session_key(state),
+        "shadow": _shadow_state(state),
+    }
+    cancelled = threading.Event()
+    with _pending_lock:
+        previous = _pending.get(state.id)
+        _pending[state.id] = cancelled
+    if previous:
+        previous.set()
+
+    # Run outside of any request's context, so the prefetch isn't part of its trace
+    _prefetch_pool.submit(
+        contextvars.Context().run, _prefetch, state, snapshot, count, cancelled
+    )
+
+
+def cancel_prefetch():
+    """
+    Stops any prefetch still running for the current session, since the player
+    has entered their next command. Called at the start of a turn.
+    """
+    state = get_current_state()
+    with _pending_lock:
+        cancelled = _pending.pop(state.id, None)
+    if cancelled and not cancelled.is_set():
+        cancelled.set()
+        prefetch_stats["cancelled"] += 1
+
+
+def take_prefetched(command):
+    """
+    Returns what was prefetched for the command in the current game state, if
+    anything: a dict with "game_command", "game_response", "llm_response",
+    "is_game_over", and the "game_state" to resume the game from
+    """
+    state = get_current_state()
+    if not config["prefetch"]["enabled"]:
+        return None
+
+    key = _session_key(state) + (normalize_game_text(command),)
+    result = _prefetched.get(key)
+    if result is None or time.monotonic() - result["time"] > config["prefetch"]["ttl"]:
+        prefetch_stats["misses"] += 1
+        return None
+    prefetch_stats["hits"] += 1
+    return result
+
+
+def rank_likely_actions(valid_actions, recent_commands):
+    """
+    Orders the valid actions by how likely the player is to enter them next,
+    judging by the commands they've entered recently: the same commands again
+    first, then those using the most of the same words
+    """
+    recent = [normalize_game_text(command) for command in recent_commands]
+    word_counts = Counter(word for command in recent for word in command.split())
+
+    def score(action):
+        words = normalize_game_text(action).split()
+        repeated = normalize_game_text(action) in recent
+        return (repeated, sum(word_counts[word] for word in words) / max(len(words), 1))
+
+    return sorted(valid_actions, key=score, reverse=True)
+
+
+def _prefetch(session, snapshot, count, cancelled):
+    # Imported here, since the engine imports this module
+    import engine
+    from game import get_current_room
+
+    shadow = snapshot["shadow"]
+    env = get_thread_env(shadow.game_path)
+    shadow.env = env
+    set_current_state(shadow)
+
+    try:
+        env.set_state(snapshot["game_state"])
+        valid_actions = get_valid_actions(env, shadow.game_path)
+        # The same window of the game log that prompts show (0 for all of it)
+        gamelog_count = config["responses"]["gamelog_count"]
+        recent_commands = [
+            text[len(config["responses"]["command_prefix"]) :].strip()
+            for is_command, text in shadow.game_chatlog.recent(2 * gamelog_count or None)
+            if is_command
+        ]
+
+        actions = []
+        results = []
+        rewrites = []
+        for action in rank_likely_actions(valid_actions, recent_commands)[:count]:
+            if cancelled.is_set():
+                return
+
+            env.set_state(snapshot["game_state"])
+            game_command, game_response, is_game_over = engine.run_command(action)
+            actions.append(action)
+            results.append(
+                {
+                    "game_command": game_command,
+                    "game_response": game_response,
+                    "is_game_over": is_game_over,
+                    "game_state": env.get_state(),
+                }
+            )
+            rewrites.append(engine.prepare_rewrite(action, game_response, get_current_room()))
+
+        if cancelled.is_set():
+            return
+        # All rewritten in one batch, rather than one LLM round trip after another
+        llm_responses = engine.rewrite_prepared(rewrites)
+        session.prefetch_budget_used += len(results)
+        prefetch_stats["prefetched"] += len(results)
+
+        # Don't keep results the player has already moved past
+        if cancelled.is_set():
+            return
+        for action, result, llm_response in zip(actions, results, llm_responses):
+            result["llm_response"] = llm_response
+            result["time"] = time.monotonic()
+            for command in _command_aliases(action):
+                _prefetched.put(snapshot["key"] + (command,), result)
+    except Exception as e:
+        # The player's next turn just runs as usual
+        increment_counter("prefetch_failures_total")
+        debug_log = get_debug_log(session)
+        if debug_log:
+            debug_log.write(f"=== PREFETCH FAILED ===\n{e!r}\n\n")
+    finally:
+        with _pending_lock:
+            if _pending.get(session.id) is cancelled:
+                del _pending[session.id]
+
+
+def _shadow_state(state):
+    """
+    Returns a stand-in for the session for running commands on the side: the
+    same game, tone and recent game log, but with nothing written back to it
+    """
+    shadow = GameState()
+    shadow.id = state.id
+    shadow.game_path = state.game_path
+    shadow.tone = state.tone
+    shadow.llm_provider = state.llm_provider
+    # Sealed segments never change, so older history is read from the session's log
+    shadow.game_chatlog = new_game_log(
+        state.game_chatlog.to_snapshot(), state.game_chatlog.read_segment
+    )
+    return shadow
+
+
+def _session_key(state):
+    return (state.id, game_state_key(state.env, state.game_path), len(state.game_chatlog))
+
+
+def _command_aliases(action):
+    action = normalize_game_text(action)
+    aliases = [action]
+    if action in _DIRECTION_ABBREVIATIONS:
+        aliases.append(_DIRECTION_ABBREVIATIONS[action])
+    elif action.startswith("go ") and action[3:] in _DIRECTION_ABBREVIATIONS:
+        aliases.extend([action[3:], _DIRECTION_ABBREVIATIONS[action[3:]]])
+    return aliases
@@ -0,0 +1,84 @@
+import os
+import threading
+
+from cache import LRUCache, PersistentLRUCache
+from state import get_current_state, config
+from utils import normalize_game_text, uses_shared_caches
+
+# Most rejected candidates remembered per command, fed back to the LLM as known failures
+MAX_BAD_REWRITES = 10
+
+# Learned command rewrites, keyed by game, player location and normalized user
+# command. Each entry holds the last fix that worked, and candidates the game rejected.
+_rewrite_table = PersistentLRUCache(
+    config["cache"]["rewrite_table_size"],
+    (
+        os.path.join(config["cache"]["dir"], "rewrites.jsonl")
+        if config["cache"]["rewrite_table_on_disk"]
+        else None
+    ),
+)
+# The same for test providers, kept in memory only
+_test_rewrite_table = LRUCache(config["cache"]["rewrite_table_size"])
+_rewrite_table_lock = threading.Lock()
+
+# Counts of learned rewrites that were used ("hits"), and parser errors that
+# had no usable learned rewrite ("misses")
+rewrite_stats = {"hits": 0, "misses": 0}
+
+
+def _get_rewrite_table():
+    return _rewrite_table if uses_shared_caches() else _test_rewrite_table
+
+
+def _rewrite_key(command):
+    state = get_current_state()
+    location = -1
+    if config["cache"]["rewrite_scope_to_location"]:
+        player_location = state.env.get_player_location()
+        if player_location is not None:
+            location = player_location.num
+
+    return (os.path.basename(state.game_path), location, normalize_game_text(command))
+
+
+def lookup_rewrite(command):
+    """
+    Returns the learned fix for a user command (or None), along with the list
+    of candidate commands the game is known to reject for it.
+    """
+    entry = _get_rewrite_table().get(_rewrite_key(command))
+    if not entry:
+        return None, []
+    return entry["fix"], entry["bad"]
+
+
+def record_rewrite(command, fix=None, bad=()):
+    """
+    Remembers a working fix and/or rejected candidates for a user command.
+    Passing fix=None keeps any fix we already know about.
+    """
+    key = _rewrite_key(command)
+    rewrite_table = _get_rewrite_table()
+    with _rewrite_table_lock:
+        entry = rewrite_table.get(key) or {"fix": None, "bad": []}
+        if fix:
+            entry = {"fix": fix, "bad": [b for b in entry["bad"] if b != fix]}
+        for candidate in bad:
+            if candidate not in entry["bad"] and candidate != entry["fix"]:
+                entry["bad"].append(candidate)
+        entry["bad"] = entry["bad"][-MAX_BAD_REWRITES:]
+        rewrite_table.put(key, entry)
+
+
+def forget_rewrite(command):
+    """
+    Drops a learned fix that no longer works, demoting it to a rejected candidate.
+    """
+    key = _rewrite_key(command)
+    rewrite_table = _get_rewrite_table()
+    with _rewrite_table_lock:
+        entry = rewrite_table.get(key)
+        if entry and entry["fix"]:
+            bad = (entry["bad"] + [entry["fix"]])[-MAX_BAD_REWRITES:]
+            rewrite_table.put(key, {"fix": None, "bad": bad})
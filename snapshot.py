@@ -0,0 +1,103 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from env_pool import get_story_bytes
+
+# Session snapshot format:
+#   header:  magic (4 bytes), format version (1 byte)
+#   body:    zlib compressed sections, each a big-endian uint32 length then its bytes:
+#            1. UTF-8 JSON with the session fields and the emulator's registers
+#            2. Z-machine RAM, XORed with the story file's initial dynamic memory
+#            3. Z-machine stack
+# Since a game only changes a small part of its memory, the XORed RAM is
+# almost all zeros and compresses to a tiny fraction of its size.
+SNAPSHOT_MAGIC = b"LIFS"
+SNAPSHOT_VERSION = 2
+# Older versions we can still read; version 1 held the whole game log
+SUPPORTED_SNAPSHOT_VERSIONS = (1, 2)
+_HEADER = struct.Struct(">4sB")
+_SECTION_LENGTH = struct.Struct(">I")
+
+
+def encode_snapshot(state):
+    """
+    Encodes all the fields of a game state that need to persist between
+    requests into a single compact binary record
+    """
+    ram, stack, pc, sp, fp, frame_count, opcode, rng, narrative = state.env.get_state()
+
+    fields = {
+        "id": state.id,
+        "game_path": state.game_path,
+        "llm_provider": state.llm_provider,
+        "tone": state.tone,
+        "version": state.version,
+        "game_chatlog": state.game_chatlog.to_snapshot(),
+        "registers": {
+            "pc": int(pc),
+            "sp": int(sp),
+            "fp": int(fp),
+            "frame_count": int(frame_count),
+            "opcode": int(opcode),
+            "rng": [int(r) for r in rng],
+            "narrative": narrative.decode("latin-1"),
+        },
+    }
+
+    sections = [
+        json.dumps(fields).encode("utf-8"),
+        _xor_with_story(ram, state.game_path).tobytes(),
+        stack.tobytes(),
+    ]
+    body = b"".join([_SECTION_LENGTH.pack(len(s)) + s for s in sections])
+    return _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION) + zlib.compress(body)
+
+
+def decode_snapshot(snapshot):
+    """
+    Decodes a record from encode_snapshot() into a dict of the session fields,
+    with "game_state" holding the tuple to pass to env.set_state()
+    """
+    magic, version = _HEADER.unpack_from(snapshot)
+    if magic != SNAPSHOT_MAGIC:
+        raise Exception("Not a game state snapshot")
+    if version not in SUPPORTED_SNAPSHOT_VERSIONS:
+        raise Exception(f"Unsupported game state snapshot version: {version}")
+
+    body = zlib.decompress(snapshot[_HEADER.size :])
+    sections = []
+    pos = 0
+    while pos < len(body):
+        (length,) = _SECTION_LENGTH.unpack_from(body, pos)
+        pos += _SECTION_LENGTH.size
+        sections.append(body[pos : pos + length])
+        pos += length
+    fields_json, ram_delta, stack = sections
+
+    fields = json.loads(fields_json.decode("utf-8"))
+    registers = fields.pop("registers")
+
+    # Copies, since Jericho needs writable arrays
+    ram = _xor_with_story(np.frombuffer(ram_delta, dtype=np.uint8), fields["game_path"])
+    stack = np.frombuffer(stack, dtype=np.uint8).copy()
+    fields["game_state"] = (
+        ram,
+        stack,
+        registers["pc"],
+        registers["sp"],
+        registers["fp"],
+        registers["frame_count"],
+        registers["opcode"],
+        tuple(registers["rng"]),
+        registers["narrative"].encode("latin-1"),
+    )
+    return fields
+
+
+def _xor_with_story(ram, game_path):
+    # The start of the story file is the game's initial dynamic memory
+    initial_memory = np.frombuffer(get_story_bytes(game_path), dtype=np.uint8)
+    return np.bitwise_xor(ram, initial_memory[: len(ram)])
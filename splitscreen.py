@@ -55,6 +55,7 @@ class SplitScreen:
         self.left_lines = []
         self.right_lines = []
         self.scroll_pos = 0  # scroll_pos number of lines we've scrolled back
+        self.partial_start = None  # where output that's still streaming in starts
 
     def get_command(self):
         self.input_win.clear()
@@ -124,6 +125,21 @@ class SplitScreen:
         self.refresh_window(self.left_win, self.left_lines)
         self.refresh_window(self.right_win, self.right_lines)
 
+    def begin_partial_output(self):
+        """
+        Marks the start of output that will be redrawn as it streams in
+        """
+        self.partial_start = (len(self.left_lines), len(self.right_lines))
+
+    def output_partial_text(self, left_msg, right_msg):
+        """
+        Replaces everything output since begin_partial_output() with the given text
+        """
+        left_start, right_start = self.partial_start
+        self.left_lines = self.left_lines[:left_start]
+        self.right_lines = self.right_lines[:right_start]
+        self.output_text(left_msg, right_msg)
+
     def scroll_up(self):
         if self.scroll_pos >= len(self.left_lines) - 1:
             return
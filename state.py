@@ -1,8 +1,15 @@
+import contextvars
+import functools
 import os
+import time
+import threading
 import toml
-import modal
 import jericho
 import uuid
+import weakref
+from collections import OrderedDict
+
+from gamelog import GameLog
 
 
 class GameState:
@@ -11,16 +18,23 @@ class GameState:
         self.log_dir = None  # directory path for debug log
         self.log_filename = None  # filename for debug log
         self.post_debug_log_write = None  # called after writing to debug log; currently used only for server to sync volume
+        self.debug_log = None  # buffered writer for the debug log, created on first write
 
         self.env = None  # the jericho Frotz environment
+        self.initial_game_response = None  # (response, info) if env was already reset for a new game
         self.game_path = ""
         self.tone = (
             None  # One of "original", "pratchett", "gumshoe", "legal", "spaceopera"
         )
         self.llm_provider = ""  # Supports "anthropic" or "hosted"
 
-        self.game_chatlog = []  # the log of game inputs and outputs
+        self.game_chatlog = new_game_log()  # the log of game inputs and outputs
         self.llm_prompt = ""  # the current LLM prompt being constructed
+        self.llm_prompt_cache_point = 0  # length of the start of llm_prompt that providers can cache
+
+        self.version = 0  # number of times this session has been saved
+        self.is_dirty = False  # has changes not yet saved to the persistent store
+        self.prefetch_budget_used = 0  # commands prefetched for this session in this process
 
 
 config = None
@@ -31,18 +45,45 @@ llm_config = None
 with open("configs/llm.toml", "r") as llm_config:
     llm_config = toml.load(llm_config)
 
-# NOTE: A bit of a hack to quickly enable both web and local execution
-_current_state = None
+# The game session being played in the current context. Each web request (and
+# each thread or task running part of a turn) sees its own session, so turns for
+# different sessions can run at the same time.
+_current_state = contextvars.ContextVar("current_state", default=None)
+
+# Locks by session id, so only one turn at a time runs for each session
+_session_locks = weakref.WeakValueDictionary()
+_session_locks_lock = threading.Lock()
 
 
 def get_current_state():
-    global _current_state
-    return _current_state
+    return _current_state.get()
 
 
 def set_current_state(state):
-    global _current_state
-    _current_state = state
+    _current_state.set(state)
+
+
+def get_session_lock(id):
+    """
+    Returns the lock to hold while running a turn for the session
+    """
+    with _session_locks_lock:
+        lock = _session_locks.get(id)
+        if lock is None:
+            lock = _session_locks[id] = threading.Lock()
+        return lock
+
+
+def new_game_log(snapshot=None, load_segment=None):
+    """
+    Creates an empty game log, or restores one from a session snapshot,
+    keeping enough recent entries in memory for building prompts
+    """
+    segment_size = config["sessions"]["gamelog_segment_size"]
+    ring_size = max(2 * config["responses"]["gamelog_count"], 1)
+    if snapshot is None:
+        return GameLog(segment_size, ring_size)
+    return GameLog.from_snapshot(snapshot, segment_size, ring_size, load_segment)
 
 
 def init_game_state(game_path, llm_provider, tone=None, id_in_log_path=False):
@@ -56,8 +97,13 @@ def init_game_state(game_path, llm_provider, tone=None, id_in_log_path=False):
     state.llm_provider = llm_provider
     state.tone = tone
 
-    env = jericho.FrotzEnv(game_path)
+    # Imported here since env_pool needs this module's config
+    from env_pool import take_env
+
+    # Pooled environments have already been reset, so hold on to the initial response
+    env, game_response, info = take_env(game_path)
     state.env = env
+    state.initial_game_response = (game_response, info)
 
     state.log_dir = "logs"
     state.log_filename = f"debug{'-' + state_id if id_in_log_path else ''}.log"
@@ -67,42 +113,133 @@ def init_game_state(game_path, llm_provider, tone=None, id_in_log_path=False):
 def save_state(state):
     """
     Used by Modal web endpoint to persist game state in between requests.
+    The whole session goes out as one snapshot, in a single write to the store,
+    along with any game log segments that filled up since the last save.
     """
-    state_dict = modal.Dict.from_name(
-        f"llm-if-wrapper-{state.id}", create_if_missing=True
-    )
+    # Imported here since these modules need this module's config
+    from snapshot import encode_snapshot
+    from storage import get_store
 
-    state_dict["id"] = state.id
-    state_dict["game_path"] = state.game_path
-    state_dict["llm_provider"] = state.llm_provider
-    state_dict["tone"] = state.tone
+    store = get_store()
+    log_segments = state.game_chatlog.unsaved_segments()
 
-    state_dict["game_chatlog"] = state.game_chatlog
-    state_dict["game_state"] = state.env.get_state()
+    state.version += 1
+    store.write(state.id, state.version, encode_snapshot(state), log_segments)
+    state.game_chatlog.mark_saved(log_segments)
+    state.game_chatlog.load_segment = functools.partial(store.read_log_segment, state.id)
+    state.is_dirty = False
 
 
 def load_state_by_id(id):
     """
     Used by Modal web endpoint to restore existing game state in between requests.
     """
-    state_dict = modal.Dict.from_name(f"llm-if-wrapper-{id}", create_if_missing=False)
-    if not state_dict:
+    from snapshot import decode_snapshot
+    from storage import get_store
+
+    store = get_store()
+    snapshot = store.read(id)
+    if not snapshot:
         raise Exception(f"Unable to load state for {id}")
+    fields = decode_snapshot(snapshot)
 
     loaded_state = GameState()
     loaded_state.id = id
-    loaded_state.game_path = state_dict["game_path"]
-    loaded_state.llm_provider = state_dict["llm_provider"]
-    loaded_state.tone = state_dict["tone"]
+    loaded_state.game_path = fields["game_path"]
+    loaded_state.llm_provider = fields["llm_provider"]
+    loaded_state.tone = fields["tone"]
 
-    loaded_state.game_chatlog = state_dict["game_chatlog"]
+    loaded_state.game_chatlog = new_game_log(
+        fields["game_chatlog"], functools.partial(store.read_log_segment, id)
+    )
     loaded_state.llm_prompt = ""
+    loaded_state.version = fields["version"]
+
+    from env_pool import take_env
 
-    env = jericho.FrotzEnv(state_dict["game_path"])
-    env.set_state(state_dict["game_state"])
+    env, _, __ = take_env(fields["game_path"])
+    env.set_state(fields["game_state"])
     loaded_state.env = env
 
     loaded_state.log_dir = "logs"
     loaded_state.log_filename = f"debug-{id}.log"
 
     return loaded_state
+
+
+# Sessions recently active in this process, with their live Frotz environments,
+# so a player's next command doesn't need to rebuild them from the persistent store.
+# Maps id -> (state, time last used), least recently used first.
+_live_states = OrderedDict()
+_live_states_lock = threading.Lock()
+
+
+def load_live_state(id):
+    """
+    Used by Modal web endpoint to get the game state for a request, from
+    the in-process cache if possible, otherwise from the persistent store.
+    """
+    evict_idle_live_states()
+
+    with _live_states_lock:
+        entry = _live_states.pop(id, None)
+
+    if entry:
+        live_state, _ = entry
+        # Another container may have served this player since, in which case
+        # the store has a newer version than ours
+        if not config["sessions"]["check_version"] or _stored_version(id) <= live_state.version:
+            return live_state
+
+    return load_state_by_id(id)
+
+
+def save_live_state(state):
+    """
+    Used by Modal web endpoint to keep the game state warm in between requests.
+    Writes through to the persistent store, unless using write-behind, in which
+    case it's only written once the state is evicted.
+    """
+    if config["sessions"]["write_behind"]:
+        state.is_dirty = True
+    else:
+        save_state(state)
+
+    with _live_states_lock:
+        _live_states.pop(state.id, None)
+        _live_states[state.id] = (state, time.monotonic())
+
+    evict_idle_live_states()
+
+
+def evict_idle_live_states(evict_all=False):
+    """
+    Drops least recently used states that have been idle too long, or that
+    don't fit under the cap, saving any unsaved changes first.
+    """
+    idle_cutoff = time.monotonic() - config["sessions"]["idle_timeout"]
+    evicted = []
+
+    with _live_states_lock:
+        while _live_states:
+            id, (state, last_used) = next(iter(_live_states.items()))
+            if (
+                not evict_all
+                and last_used > idle_cutoff
+                and len(_live_states) <= config["sessions"]["max_live"]
+            ):
+                break
+            _live_states.popitem(last=False)
+            evicted.append(state)
+
+    for state in evicted:
+        if state.is_dirty:
+            save_state(state)
+        if state.debug_log:
+            state.debug_log.close()
+
+
+def _stored_version(id):
+    from storage import get_store
+
+    return get_store().read_version(id)
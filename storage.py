@@ -0,0 +1,127 @@
+import json
+import os
+import sqlite3
+import threading
+
+from state import config
+
+
+class ModalDictStore:
+    """
+    Keeps each session's snapshot in its own Modal Dict, along with its version
+    so that can be checked without fetching the whole snapshot, and the sealed
+    segments of its game log
+    """
+
+    def _session_dict(self, id, create_if_missing=False):
+        import modal
+
+        return modal.Dict.from_name(
+            f"llm-if-wrapper-{id}", create_if_missing=create_if_missing
+        )
+
+    def read(self, id):
+        return self._session_dict(id).get("snapshot")
+
+    def read_version(self, id):
+        return self._session_dict(id).get("version", 0)
+
+    def read_log_segment(self, id, index):
+        return self._session_dict(id)[f"log_segment_{index}"]
+
+    def write(self, id, version, snapshot, log_segments=None):
+        # Everything goes in a single round trip
+        segments = {f"log_segment_{index}": entries for index, entries in (log_segments or {}).items()}
+        self._session_dict(id, create_if_missing=True).update(
+            snapshot=snapshot, version=version, **segments
+        )
+
+
+class SQLiteStore:
+    """
+    Keeps session snapshots in a local SQLite database, for running and
+    testing without Modal
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # SQLite connections can't be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path)
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions"
+                " (id TEXT PRIMARY KEY, version INTEGER, snapshot BLOB)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS log_segments"
+                " (id TEXT, segment INTEGER, entries TEXT, PRIMARY KEY (id, segment))"
+            )
+            self._local.connection = connection
+        return connection
+
+    def read(self, id):
+        row = (
+            self._connection()
+            .execute("SELECT snapshot FROM sessions WHERE id = ?", (id,))
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def read_version(self, id):
+        row = (
+            self._connection()
+            .execute("SELECT version FROM sessions WHERE id = ?", (id,))
+            .fetchone()
+        )
+        return row[0] if row else 0
+
+    def read_log_segment(self, id, index):
+        row = (
+            self._connection()
+            .execute(
+                "SELECT entries FROM log_segments WHERE id = ? AND segment = ?", (id, index)
+            )
+            .fetchone()
+        )
+        if row is None:
+            raise Exception(f"Missing game log segment {index} for {id}")
+        return json.loads(row[0])
+
+    def write(self, id, version, snapshot, log_segments=None):
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO sessions (id, version, snapshot) VALUES (?, ?, ?)",
+                (id, version, snapshot),
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO log_segments (id, segment, entries) VALUES (?, ?, ?)",
+                [
+                    (id, index, json.dumps(entries))
+                    for index, entries in (log_segments or {}).items()
+                ],
+            )
+
+
+_store = None
+
+
+def get_store():
+    """
+    Returns the persistent store for game sessions configured in [storage]
+    """
+    global _store
+    if _store is None:
+        backend = config["storage"]["backend"]
+        if backend == "modal":
+            _store = ModalDictStore()
+        elif backend == "sqlite":
+            _store = SQLiteStore(config["storage"]["sqlite_path"])
+        else:
+            raise Exception(f"Unsupported storage backend: {backend}")
+    return _store
@@ -0,0 +1,74 @@
+import math
+import random
+import re
+
+from jericho.util import recognized
+
+from state import llm_config
+
+# Parser rejections Jericho doesn't recognize as such, from games' own parsers
+PARSER_ERROR_PATTERNS = [
+    re.compile(pattern, re.IGNORECASE)
+    for pattern in (
+        r"(noun|verb) error",
+        r"not understood",
+        r"I beg your pardon",
+        r"I only understood you as far as",
+        r"I didn't understand (that|the word)",
+        r"I don't (understand|know the word)",
+        r"That's not a verb",
+        r"^\[?What do you want to \w+",
+        r"You seem to have said too much",
+        r"Please answer yes or n",
+    )
+]
+
+
+def stub_llm_response(system_prompt, user_prompt):
+    """
+    Returns a canned response to the prompts without calling any LLM, and how
+    many seconds to wait before giving it to simulate an LLM's latency.
+
+    Parser error checks are answered "yes" when the game's response looks like
+    a parser rejection and "no" otherwise, parser fixes with the possible action
+    sharing the most words with the player's command, and rewrites with the
+    original game response.
+    """
+    if "<suggested_command>" in user_prompt:
+        response = _stub_fix(user_prompt)
+    elif "<command>" in user_prompt:
+        response = "yes" if _is_parser_rejection(_last_tagged(user_prompt, "response")) else "no"
+    else:
+        response = _last_tagged(user_prompt, "response") or _last_tagged(
+            user_prompt, "startup_text"
+        )
+
+    median = llm_config["stub"]["latency_median"]
+    latency = (
+        random.lognormvariate(math.log(median), llm_config["stub"]["latency_sigma"])
+        if median > 0
+        else 0.0
+    )
+    return response, latency
+
+
+def _is_parser_rejection(response):
+    if not recognized(response):
+        return True
+    return any(pattern.search(response) for pattern in PARSER_ERROR_PATTERNS)
+
+
+def _stub_fix(user_prompt):
+    command_words = set((_last_tagged(user_prompt, "player_command") or "").lower().split())
+    actions = (_last_tagged(user_prompt, "possible_actions") or "").splitlines()
+    actions = [a.strip() for a in actions if a.strip()]
+    if not actions:
+        return "No suggestions."
+
+    best = max(actions, key=lambda a: len(command_words & set(a.lower().split())))
+    return f"<suggested_command>{best}</suggested_command>"
+
+
+def _last_tagged(text, tag):
+    matches = re.findall(rf"<{tag}>(.*?)</{tag}>", text, re.DOTALL)
+    return matches[-1].strip() if matches else ""
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules read their configs relative to the working directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
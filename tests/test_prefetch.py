@@ -0,0 +1,37 @@
+import time
+
+import prefetch
+from game import add_to_game_log
+from state import config, init_game_state, llm_config, set_current_state
+
+
+def test_prefetch_after_sealed_log_segments(monkeypatch):
+    monkeypatch.setitem(config["prefetch"], "enabled", True)
+    monkeypatch.setitem(llm_config["stub"], "latency_median", 0)
+    # Valid actions aren't what's being tested, and are slow to work out
+    monkeypatch.setattr(
+        prefetch, "get_valid_actions", lambda env, game_path: ["open mailbox", "north"]
+    )
+
+    state = init_game_state("games/zork1.z5", "stub", "pratchett")
+    state.log_dir = None
+    set_current_state(state)
+
+    # More than one segment of history, with the sealed ones saved to the
+    # store and dropped from memory, as the web endpoint does
+    for turn in range(config["sessions"]["gamelog_segment_size"] + 10):
+        add_to_game_log("look", is_command=True)
+        add_to_game_log(f"West of House, turn {turn}", is_command=False)
+    saved = state.game_chatlog.unsaved_segments()
+    state.game_chatlog.mark_saved(saved)
+    state.game_chatlog.load_segment = saved.__getitem__
+
+    prefetch.start_prefetch()
+    deadline = time.monotonic() + 60
+    while state.id in prefetch._pending and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    result = prefetch.take_prefetched("open mailbox")
+    assert result is not None
+    assert "mailbox" in result["game_response"]
+    assert prefetch.take_prefetched("n") is not None
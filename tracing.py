@@ -0,0 +1,157 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Trace:
+    """
+    The timed spans recorded during one turn. Nested spans are recorded
+    separately, so a span's duration includes the spans inside it.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()  # spans can be recorded from worker threads
+
+    def add(self, name, start, duration, attributes):
+        with self._lock:
+            self.spans.append(
+                {
+                    "name": name,
+                    "start": start - self.start,
+                    "duration": duration,
+                    "attributes": attributes,
+                }
+            )
+
+    def stage_totals(self):
+        """
+        Returns the total time spent in spans of each name
+        """
+        totals = {}
+        for span in self.spans:
+            totals[span["name"]] = totals.get(span["name"], 0.0) + span["duration"]
+        return totals
+
+    def find(self, name):
+        return [span for span in self.spans if span["name"] == name]
+
+    def to_json(self):
+        with self._lock:
+            return {"duration": time.perf_counter() - self.start, "spans": list(self.spans)}
+
+
+# The trace for the turn being run in the current context, if it's being traced
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+# Upper bounds in seconds of the histogram buckets that span durations are counted in
+HISTOGRAM_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Span attributes that become labels of the span duration histograms
+HISTOGRAM_LABELS = ("provider",)
+
+# Durations of every span since the process started, whether traced or not,
+# by (span name, labels), as [bucket counts, sum, count]
+_histograms = {}
+# Running totals by (counter name, labels)
+_counters = {}
+_metrics_lock = threading.Lock()
+
+
+def start_trace():
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+
+def end_trace():
+    trace = _current_trace.get()
+    _current_trace.set(None)
+    return trace
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the enclosed block as a span of the current trace. Yields the span's
+    attributes, so more can be added once they're known.
+    """
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        add_span(name, start, **attributes)
+
+
+def add_span(name, start, **attributes):
+    """
+    Records a span that started at the given time.perf_counter() value and ends now,
+    for code that can't be wrapped in span()
+    """
+    duration = time.perf_counter() - start
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, start, duration, attributes)
+
+    labels = tuple([(label, str(attributes[label])) for label in HISTOGRAM_LABELS if label in attributes])
+    with _metrics_lock:
+        histogram = _histograms.get((name, labels))
+        if histogram is None:
+            histogram = _histograms[(name, labels)] = [[0] * len(HISTOGRAM_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if duration <= bound:
+                histogram[0][i] += 1
+        histogram[1] += duration
+        histogram[2] += 1
+
+
+def increment_counter(name, value=1, **labels):
+    """
+    Adds to a running total reported by render_metrics(), e.g. tokens used
+    """
+    key = (name, tuple(sorted([(label, str(v)) for label, v in labels.items()])))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def render_metrics(gauges=None, namespace="llm_if"):
+    """
+    Returns the span duration histograms and counters in Prometheus' text format,
+    along with any other values given in gauges by name
+    """
+    with _metrics_lock:
+        histograms = {key: (list(h[0]), h[1], h[2]) for key, h in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = [
+        f"# HELP {namespace}_span_seconds Time spent in each stage of a turn",
+        f"# TYPE {namespace}_span_seconds histogram",
+    ]
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+        span_labels = [("span", name)] + list(labels)
+        for bound, bucket_count in zip(HISTOGRAM_BUCKETS, buckets):
+            lines.append(
+                f"{namespace}_span_seconds_bucket{_format_labels(span_labels + [('le', str(bound))])} {bucket_count}"
+            )
+        lines.append(f"{namespace}_span_seconds_bucket{_format_labels(span_labels + [('le', '+Inf')])} {count}")
+        lines.append(f"{namespace}_span_seconds_sum{_format_labels(span_labels)} {total}")
+        lines.append(f"{namespace}_span_seconds_count{_format_labels(span_labels)} {count}")
+
+    for counter_name in sorted(set([name for name, _ in counters])):
+        lines.append(f"# TYPE {namespace}_{counter_name} counter")
+        for (name, labels), value in sorted(counters.items()):
+            if name == counter_name:
+                lines.append(f"{namespace}_{name}{_format_labels(labels)} {value}")
+
+    for name, value in sorted((gauges or {}).items()):
+        lines.append(f"# TYPE {namespace}_{name} gauge")
+        lines.append(f"{namespace}_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = [(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels]
+    return "{" + ",".join([f'{k}="{v}"' for k, v in escaped]) + "}"
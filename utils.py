@@ -1,17 +1,52 @@
+import asyncio
+import contextvars
 import io
+import re
 import textwrap
+import threading
+import time
 import os
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import anthropic
+import openai
 from together import Together
 from anthropic import Anthropic
 from openai import OpenAI
 
 from state import get_current_state, llm_config, config
 from llm_serve import LLM
+from debuglog import DebugLogWriter
+from cassette import record_llm_response, replay_llm_response
+from stub_llm import stub_llm_response
+from tracing import add_span, increment_counter
 
 ANTHROPIC_MODEL = "claude-sonnet-4-5-20250929"
 OPENAI_MODEL = "gpt-5-nano"
 TOGETHER_MODEL = "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free"
 
+# LLM provider clients, built once per process and shared by all calls and
+# sessions so that requests reuse pooled keep-alive connections
+_llm_clients = {}
+_llm_clients_lock = threading.Lock()
+
+# Instructions that start every prompt of a kind, by call type. They only vary
+# by tone, so they form a prefix the LLM provider can cache.
+STATIC_PROMPT_BLOCKS = {
+    "init": ["tone", "length", "formatting", "caveat"],
+    "rewrite": ["tone", "length", "formatting", "caveat"],
+}
+_static_prompt_prefixes = {}
+
+# Input tokens sent to LLM providers, and how many of those were read from
+# ("cache_read_tokens") or written to ("cache_write_tokens") the provider's prompt cache
+prompt_cache_stats = {
+    "requests": 0,
+    "input_tokens": 0,
+    "cache_read_tokens": 0,
+    "cache_write_tokens": 0,
+}
+
 def format_with_linebreaks(text: str, width: int) -> str:
     lines = []
     for line in text.split("\n"):
@@ -21,20 +56,48 @@ def format_with_linebreaks(text: str, width: int) -> str:
     return "\n".join(lines)
 
 
+def normalize_game_text(text):
+    """
+    Normalizes a command or game response for use as a cache key, ignoring
+    case, whitespace and the trailing input prompt.
+    """
+    text = text.strip()
+    if text.endswith(">"):
+        text = text[:-1]
+    return " ".join(text.lower().split())
+
+
 def write_to_debug_log(output):
+    """
+    Adds to the current session's debug log. Entries are buffered, and only
+    written out (and synced) when the log is flushed at the end of the turn.
+    """
     state = get_current_state()
-    if state.log_dir and state.log_filename:
-        # Create log directory if it doesn't exist
-        os.makedirs(state.log_dir, exist_ok=True)
+    debug_log = get_debug_log(state)
+    if debug_log:
+        debug_log.write(output)
 
-        # Construct the full debug path
-        debug_path = os.path.join(state.log_dir, state.log_filename)
 
-        with open(debug_path, "a+") as f:
-            f.write(output)
+def flush_debug_log(close=True):
+    """
+    Writes out the current session's buffered debug log entries; called once per turn
+    """
+    state = get_current_state()
+    if state and state.debug_log:
+        state.debug_log.flush(close=close)
+
 
-        if state.post_debug_log_write:
-            state.post_debug_log_write()
+def get_debug_log(state):
+    """
+    Returns the debug log writer for the session, creating it on first use
+    """
+    if state.debug_log is None and state.log_dir and state.log_filename:
+        state.debug_log = DebugLogWriter(
+            os.path.join(state.log_dir, state.log_filename),
+            # Looked up on each flush, since the web endpoint sets it per request
+            on_flush=lambda: state.post_debug_log_write and state.post_debug_log_write(),
+        )
+    return state.debug_log
 
 
 def get_llm_response_for_current_prompt():
@@ -43,24 +106,285 @@ def get_llm_response_for_current_prompt():
 
     TODO: Do we want to send previous game log for more consistency?
     """
+    return make_llm_inference(*take_current_llm_prompt())
+
+
+def get_llm_response_stream_for_current_prompt():
+    """
+    Like get_llm_response_for_current_prompt(), but yields the response in
+    pieces as the LLM generates it
+    """
+    yield from make_llm_inference_stream(*take_current_llm_prompt())
+
+
+def get_llm_response_for_current_prompt_async():
+    """
+    Like get_llm_response_for_current_prompt(), but returns an awaitable. The
+    prompt is taken right away, so the next one can be built while it's awaited.
+    """
+    return make_llm_inference_async(*take_current_llm_prompt())
+
+
+def get_llm_response_stream_for_current_prompt_async():
+    """
+    Like get_llm_response_stream_for_current_prompt(), but returns an async
+    generator, taking the prompt right away
+    """
+    return make_llm_inference_stream_async(*take_current_llm_prompt())
+
+
+def take_current_llm_prompt():
+    """
+    Returns the system prompt, the current LLM prompt being built and its cache
+    point, for sending now or later, and starts a new current prompt
+    """
     state = get_current_state()
-    response = make_llm_inference(config["init"]["system_prompt"], state.llm_prompt)
+    prompt = (config["init"]["system_prompt"], state.llm_prompt, state.llm_prompt_cache_point)
     # reset the current LLM prompt
     state.llm_prompt = ""
+    state.llm_prompt_cache_point = 0
+    return prompt
+
+
+def get_llm_client(provider):
+    """
+    Returns the long-lived client for the given LLM provider, creating it
+    on first use.
+    """
+    client = _llm_clients.get(provider)
+    if client is not None:
+        return client
+
+    with _llm_clients_lock:
+        if provider not in _llm_clients:
+            _llm_clients[provider] = _create_llm_client(provider)
+        return _llm_clients[provider]
+
+
+def _connection_limits():
+    pool_config = llm_config["clients"]
+    return httpx.Limits(
+        max_connections=pool_config["max_connections"],
+        max_keepalive_connections=pool_config["max_keepalive_connections"],
+        keepalive_expiry=pool_config["keepalive_expiry"],
+    )
+
+
+def _create_llm_client(provider):
+    limits = _connection_limits()
 
-    return response
+    if provider == "together":
+        # The Together SDK manages its own HTTP session, so we can only
+        # keep the client itself alive
+        return Together(api_key=os.environ.get("TOGETHER_API_KEY"))
+    elif provider == "anthropic":
+        return Anthropic(
+            api_key=os.environ.get("ANTHROPIC_API_KEY"),
+            http_client=anthropic.DefaultHttpxClient(limits=limits),
+        )
+    elif provider == "openai":
+        return OpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            http_client=openai.DefaultHttpxClient(limits=limits),
+        )
+    elif provider == "hosted":
+        return LLM()
+    else:
+        raise Exception(f"Unsupported LLM provider: {provider}")
+
+
+def _anthropic_prompt(system_prompt, user_prompt, cache_point=0):
+    """
+    Returns the system prompt and messages for an Anthropic request, marking
+    the system prompt and the first cache_point characters of the user prompt
+    as cacheable
+    """
+    if not llm_config["config"]["prompt_caching"]:
+        return system_prompt, [{"role": "user", "content": user_prompt}]
+
+    cache_control = {"type": "ephemeral"}
+    system = [{"type": "text", "text": system_prompt, "cache_control": cache_control}]
+    if 0 < cache_point < len(user_prompt):
+        content = [
+            {"type": "text", "text": user_prompt[:cache_point], "cache_control": cache_control},
+            {"type": "text", "text": user_prompt[cache_point:]},
+        ]
+    else:
+        content = user_prompt
+    return system, [{"role": "user", "content": content}]
+
+
+def _record_prompt_cache_usage(provider, usage):
+    """
+    Adds the token usage of an Anthropic or OpenAI response to prompt_cache_stats
+    and the token counters, and returns it for the inference's tracing span
+    """
+    if usage is None:
+        return {}
+
+    if provider == "anthropic":
+        cache_read = usage.cache_read_input_tokens or 0
+        cache_write = usage.cache_creation_input_tokens or 0
+        # Anthropic counts cached tokens separately from the rest of the input
+        input_tokens = usage.input_tokens + cache_read + cache_write
+        output_tokens = usage.output_tokens
+    else:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cache_read = (details.cached_tokens or 0) if details else 0
+        cache_write = 0
+        input_tokens = usage.prompt_tokens
+        output_tokens = usage.completion_tokens
+
+    prompt_cache_stats["requests"] += 1
+    prompt_cache_stats["input_tokens"] += input_tokens
+    prompt_cache_stats["cache_read_tokens"] += cache_read
+    prompt_cache_stats["cache_write_tokens"] += cache_write
+    write_to_debug_log(
+        f"=== LLM PROMPT CACHE ({provider}) ===\n"
+        f"{cache_read} of {input_tokens} input tokens read from cache, {cache_write} written\n\n"
+    )
+
+    token_usage = {
+        "prompt_tokens": input_tokens,
+        "completion_tokens": output_tokens,
+        "cache_read_tokens": cache_read,
+        "cache_write_tokens": cache_write,
+    }
+    for kind, count in token_usage.items():
+        increment_counter("llm_tokens_total", count, provider=provider, kind=kind[: -len("_tokens")])
+    return token_usage
+
+
+# Providers for testing, which keep to memory-only caches. What offline providers
+# say about a game mustn't be served to live sessions from the on-disk caches, and
+# recording and replaying a cassette must make the same LLM calls however warm
+# the on-disk caches happen to be.
+TEST_PROVIDERS = ("stub", "replay", "record")
+
+
+def uses_shared_caches():
+    """
+    Whether the current session's LLM answers can be kept in (and served from)
+    the on-disk caches shared with other sessions
+    """
+    return get_current_state().llm_provider not in TEST_PROVIDERS
+
+
+def offline_llm_response(provider, system_prompt, user_prompt):
+    """
+    Returns a response from the "replay" or "stub" provider, and how long to
+    wait before giving it
+    """
+    if provider == "replay":
+        return replay_llm_response(system_prompt, user_prompt)
+    return stub_llm_response(system_prompt, user_prompt)
+
+
+def make_llm_inference(system_prompt, user_prompt, cache_point=0):
+    return "".join(_llm_inference(system_prompt, user_prompt, cache_point, stream=False))
+
+
+def make_llm_inference_stream(system_prompt, user_prompt, cache_point=0):
+    """
+    Like make_llm_inference(), but yields the response text in pieces as the
+    provider streams it back
+    """
+    yield from _llm_inference(system_prompt, user_prompt, cache_point, stream=True)
+
+
+async def make_llm_inference_async(system_prompt, user_prompt, cache_point=0):
+    """
+    Like make_llm_inference(), but awaits the LLM without blocking the event
+    loop. The request is made from a worker thread, in a copy of this context.
+    """
+    return await asyncio.to_thread(make_llm_inference, system_prompt, user_prompt, cache_point)
+
+
+async def make_llm_inference_stream_async(system_prompt, user_prompt, cache_point=0):
+    """
+    Like make_llm_inference_stream(), but an async generator. The response is
+    streamed from a worker thread, which stops once this generator is closed.
+    """
+    loop = asyncio.get_running_loop()
+    pieces = asyncio.Queue()
+    closed = threading.Event()
 
+    def stream():
+        segments = make_llm_inference_stream(system_prompt, user_prompt, cache_point)
+        try:
+            for segment in segments:
+                if closed.is_set():
+                    return
+                loop.call_soon_threadsafe(pieces.put_nowait, ("segment", segment))
+            loop.call_soon_threadsafe(pieces.put_nowait, ("done", None))
+        except Exception as e:
+            loop.call_soon_threadsafe(pieces.put_nowait, ("error", e))
+        finally:
+            segments.close()
 
-def make_llm_inference(system_prompt, user_prompt):
+    streaming = asyncio.ensure_future(asyncio.to_thread(stream))
+    try:
+        while True:
+            kind, value = await pieces.get()
+            if kind == "error":
+                raise value
+            if kind == "done":
+                break
+            yield value
+        await streaming
+    finally:
+        closed.set()
 
+
+def _llm_inference(system_prompt, user_prompt, cache_point, stream):
+    """
+    Yields the LLM response to the prompts in pieces as they arrive, or all in
+    one piece unless streaming. Logs the request and response, records them
+    when recording, and times the inference as a tracing span.
+    """
     state = get_current_state()
     write_to_debug_log(f"=== LLM REQUEST ({state.llm_provider}) ===\n")
     write_to_debug_log(user_prompt + "\n\n")
 
+    # When recording, the configured live provider answers, and we keep what it said
+    provider = state.llm_provider
+    is_recording = provider == "record"
+    if is_recording:
+        provider = llm_config["cassette"]["record_provider"]
+    start_time = time.monotonic()
+    span_start = time.perf_counter()
+    token_usage = {}  # filled in for providers that report it
+    segments = []
+
+    transport = _stream_llm_response if stream else _request_llm_response
+    for segment in transport(provider, system_prompt, user_prompt, cache_point, token_usage):
+        segments.append(segment)
+        yield segment
+    response = "".join(segments)
+
+    if is_recording:
+        record_llm_response(system_prompt, user_prompt, response, time.monotonic() - start_time)
+
+    write_to_debug_log(f"=== LLM RESPONSE ({state.llm_provider}) ===\n")
+    write_to_debug_log(response + "\n\n")
+    add_span(
+        "llm_inference",
+        span_start,
+        provider=provider,
+        prompt_chars=len(system_prompt) + len(user_prompt),
+        **token_usage,
+    )
+
+
+def _request_llm_response(provider, system_prompt, user_prompt, cache_point, token_usage):
+    """
+    Yields the provider's whole response to the prompts as one piece, adding
+    the token usage to token_usage for providers that report it
+    """
     prompt = {"role": "user", "content": user_prompt}
 
-    if state.llm_provider == "together":
-        client = Together(api_key=os.environ.get("TOGETHER_API_KEY"))
+    if provider == "together":
+        client = get_llm_client("together")
 
         resp = client.chat.completions.create(
             model=TOGETHER_MODEL,
@@ -68,21 +392,23 @@ def make_llm_inference(system_prompt, user_prompt):
             max_tokens=llm_config["config"]["max_tokens"],
             temperature=llm_config["config"]["temp"],
         )
-        response = resp.choices[0].message.content
+        yield resp.choices[0].message.content
 
-    elif state.llm_provider == "anthropic":
-        llm_client = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+    elif provider == "anthropic":
+        llm_client = get_llm_client("anthropic")
+        system, messages = _anthropic_prompt(system_prompt, user_prompt, cache_point)
 
         resp = llm_client.messages.create(
             model=ANTHROPIC_MODEL,
-            system=system_prompt,
+            system=system,
             max_tokens=llm_config["config"]["max_tokens"],
-            messages=[prompt],
+            messages=messages,
             temperature=llm_config["config"]["temp"],
         )
-        response = resp.content[0].text
-    elif state.llm_provider == "openai":
-        llm_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        token_usage.update(_record_prompt_cache_usage("anthropic", resp.usage))
+        yield resp.content[0].text
+    elif provider == "openai":
+        llm_client = get_llm_client("openai")
 
         completion = llm_client.chat.completions.create(
             model=OPENAI_MODEL,
@@ -91,33 +417,221 @@ def make_llm_inference(system_prompt, user_prompt):
                 prompt,
             ],
         )
-        response = completion.choices[0].message.content
-    elif state.llm_provider == "hosted":
-        llm = LLM()
-        response = ""
-        for segment in llm.completion_stream.remote_gen(
+        token_usage.update(_record_prompt_cache_usage("openai", completion.usage))
+        yield completion.choices[0].message.content
+    elif provider == "hosted":
+        llm = get_llm_client("hosted")
+        yield "".join(
+            llm.completion_stream.remote_gen(
+                [{"role": "system", "content": system_prompt}, prompt],
+                temp=llm_config["config"]["temp"],
+                max_tokens=llm_config["config"]["max_tokens"],
+            )
+        )
+    elif provider in ("replay", "stub"):
+        response, latency = offline_llm_response(provider, system_prompt, user_prompt)
+        time.sleep(latency)
+        yield response
+    elif provider == "webllm":
+        # WebLLM inference is handled client-side in the browser
+        # Return empty response and let the frontend handle it
+        yield "[Check browser console for response]"
+    else:
+        raise Exception(f"Unsupported LLM provider: {provider}")
+
+
+def _stream_llm_response(provider, system_prompt, user_prompt, cache_point, token_usage):
+    """
+    Like _request_llm_response(), but yields the response in pieces as the
+    provider streams it back
+    """
+    prompt = {"role": "user", "content": user_prompt}
+
+    if provider == "together":
+        client = get_llm_client("together")
+
+        for chunk in client.chat.completions.create(
+            model=TOGETHER_MODEL,
+            messages=[prompt],
+            max_tokens=llm_config["config"]["max_tokens"],
+            temperature=llm_config["config"]["temp"],
+            stream=True,
+        ):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    elif provider == "anthropic":
+        llm_client = get_llm_client("anthropic")
+        system, messages = _anthropic_prompt(system_prompt, user_prompt, cache_point)
+
+        with llm_client.messages.stream(
+            model=ANTHROPIC_MODEL,
+            system=system,
+            max_tokens=llm_config["config"]["max_tokens"],
+            messages=messages,
+            temperature=llm_config["config"]["temp"],
+        ) as stream:
+            yield from stream.text_stream
+            token_usage.update(
+                _record_prompt_cache_usage("anthropic", stream.get_final_message().usage)
+            )
+    elif provider == "openai":
+        llm_client = get_llm_client("openai")
+
+        for chunk in llm_client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                prompt,
+            ],
+            stream=True,
+            stream_options={"include_usage": True},
+        ):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if chunk.usage:
+                # Only the last chunk has the usage
+                token_usage.update(_record_prompt_cache_usage("openai", chunk.usage))
+    elif provider == "hosted":
+        llm = get_llm_client("hosted")
+        yield from llm.completion_stream.remote_gen(
             [{"role": "system", "content": system_prompt}, prompt],
             temp=llm_config["config"]["temp"],
             max_tokens=llm_config["config"]["max_tokens"],
-        ):
-            response += segment
-    elif state.llm_provider == "webllm":
-        # WebLLM inference is handled client-side in the browser
-        # Return empty response and let the frontend handle it
-        response = "[Check browser console for response]"
+        )
+    elif provider in ("replay", "stub"):
+        response, latency = offline_llm_response(provider, system_prompt, user_prompt)
+        time.sleep(latency)
+        # Stream it back a word at a time, like a live provider would
+        yield from re.findall(r"\s*\S+|\s+$", response) or [response]
     else:
-        raise Exception(f"Unsupported LLM provider: {state.llm_provider}")
+        # Nothing else streams, so the whole response comes as one piece
+        yield from _request_llm_response(provider, system_prompt, user_prompt, cache_point, token_usage)
+
+
+def make_llm_inference_batch(prompts, cache_point=0):
+    """
+    Makes one LLM inference for each of the given (system prompt, user prompt)
+    pairs, returning the responses in the same order. The hosted model gets them
+    all at once, so it can batch them; other providers get them concurrently,
+    at most [batch] max_concurrency at a time.
+    """
+    if not prompts:
+        return []
+
+    state = get_current_state()
+    provider = state.llm_provider
+
+    if provider == "hosted":
+        return _make_hosted_inference_batch(prompts)
+    elif provider in ("replay", "stub"):
+        return _make_offline_inference_batch(provider, prompts)
+
+    # Each request runs in a copy of this context, so it logs to the same session
+    context = contextvars.copy_context()
+    max_workers = min(llm_config["batch"]["max_concurrency"], len(prompts))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(
+            pool.map(
+                lambda prompt: context.copy().run(
+                    make_llm_inference, prompt[0], prompt[1], cache_point
+                ),
+                prompts,
+            )
+        )
+
+
+def _make_hosted_inference_batch(prompts):
+    span_start = time.perf_counter()
+    for _, user_prompt in prompts:
+        write_to_debug_log("=== LLM REQUEST (hosted) ===\n")
+        write_to_debug_log(user_prompt + "\n\n")
+
+    llm = get_llm_client("hosted")
+    responses = llm.completion_batch.remote(
+        [
+            [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ]
+            for system_prompt, user_prompt in prompts
+        ],
+        temp=llm_config["config"]["temp"],
+        max_tokens=llm_config["config"]["max_tokens"],
+    )
+
+    _log_batch_responses("hosted", prompts, responses, span_start)
+    return responses
 
-    write_to_debug_log(f"=== LLM RESPONSE ({state.llm_provider}) ===\n")
-    write_to_debug_log(response + "\n\n")
 
-    return response
+def _make_offline_inference_batch(provider, prompts):
+    """
+    Answers a batch from the "replay" or "stub" provider the way a batching
+    model server would: all at once, after the slowest of them is done
+    """
+    span_start = time.perf_counter()
+    for _, user_prompt in prompts:
+        write_to_debug_log(f"=== LLM REQUEST ({provider}) ===\n")
+        write_to_debug_log(user_prompt + "\n\n")
+
+    results = [offline_llm_response(provider, system, user) for system, user in prompts]
+    time.sleep(max(latency for _, latency in results))
+
+    responses = [response for response, _ in results]
+    _log_batch_responses(provider, prompts, responses, span_start)
+    return responses
+
+
+def _log_batch_responses(provider, prompts, responses, span_start):
+    for response in responses:
+        write_to_debug_log(f"=== LLM RESPONSE ({provider}) ===\n")
+        write_to_debug_log(response + "\n\n")
+    add_span(
+        "llm_inference_batch",
+        span_start,
+        provider=provider,
+        count=len(prompts),
+        prompt_chars=sum(len(system) + len(user) for system, user in prompts),
+    )
 
 
 def concat_current_llm_prompt(prompt):
     state = get_current_state()
+    state.llm_prompt = _concat_prompt(state.llm_prompt, prompt)
+    return
+
+
+def _concat_prompt(llm_prompt, prompt):
     if not prompt[-1] == ">":
-        state.llm_prompt = state.llm_prompt + "\n"
+        llm_prompt = llm_prompt + "\n"
+    return llm_prompt + prompt
 
-    state.llm_prompt = state.llm_prompt + prompt
-    return
+
+def mark_llm_prompt_cache_point():
+    """
+    Marks the current LLM prompt built so far as the part that will be sent
+    unchanged again, so the LLM provider can cache it
+    """
+    state = get_current_state()
+    state.llm_prompt_cache_point = len(state.llm_prompt)
+
+
+def add_static_prompt_prefix(call_type):
+    """
+    Starts the current LLM prompt with the instructions that are the same for
+    every prompt of this call type and the session's tone, and marks them as
+    cacheable. Everything that changes from turn to turn should come after.
+    """
+    state = get_current_state()
+    key = (call_type, state.tone)
+    prefix = _static_prompt_prefixes.get(key)
+    if prefix is None:
+        prefix = ""
+        for block in STATIC_PROMPT_BLOCKS[call_type]:
+            if block == "tone":
+                block = "tone_" + state.tone
+            prefix = _concat_prompt(prefix, config["style"][block])
+        _static_prompt_prefixes[key] = prefix
+
+    state.llm_prompt = state.llm_prompt + prefix
+    mark_llm_prompt_cache_point()
@@ -0,0 +1,328 @@
+import hashlib
+import multiprocessing
+import threading
+from multiprocessing import util as multiprocessing_util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from jericho.util import verb_usage_count
+from jericho.defines import TemplateAction
+
+from cache import LRUCache
+from env_pool import create_env, get_thread_env
+from state import config, get_current_state
+from tracing import increment_counter
+
+# Valid actions by game and game state fingerprint, shared by all sessions
+_valid_actions = LRUCache(config["valid_actions"]["cache_size"])
+
+# Game states whose valid actions are being worked out, so concurrent
+# requests for the same state wait on one computation
+_in_progress = {}
+_in_progress_lock = threading.Lock()
+
+# Worker processes, each with its own Frotz environment per game, for testing
+# chunks of candidate actions in parallel. Started at web startup or on first use,
+# and again whenever a worker dies and takes the pool down with it. Candidates
+# are tested in-process until the workers are up, which takes several seconds.
+_worker_pool = None
+_worker_pool_ready = threading.Event()
+_worker_pool_lock = threading.Lock()
+
+# Background threads working out valid actions ahead of time
+_precompute_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="valid_actions")
+
+_partial_results = 0
+
+
+def game_state_key(env, game_path):
+    """
+    Returns a cheap fingerprint of the environment's game state, which changes
+    whenever anything in the Z-machine's memory does.
+
+    NOTE: Jericho's get_world_state_hash() only covers the object tree, and
+    takes several times longer to compute than stepping "look".
+    """
+    ram = env.get_state()[0]
+    return (game_path, hashlib.blake2b(ram.tobytes(), digest_size=16).hexdigest())
+
+
+def get_valid_actions(env, game_path, time_budget=None):
+    """
+    Returns the valid actions in the environment's current game state, like
+    env.get_valid_actions(), but cached by game state, with the candidate actions
+    tested in parallel by worker processes.
+
+    If they take longer than the time budget (in seconds; by default [valid_actions]
+    time_budget, where 0 means no limit), returns the actions found so far. The
+    rest are still worked out, and cached once they're all done.
+    """
+    key = game_state_key(env, game_path)
+    actions = _valid_actions.get(key)
+    if actions is not None:
+        return actions
+
+    with _in_progress_lock:
+        computation = _in_progress.get(key)
+        is_new = computation is None
+        if is_new:
+            computation = _in_progress[key] = _Computation(key)
+    if is_new:
+        computation.start(env, game_path)
+
+    if time_budget is None:
+        time_budget = config["valid_actions"]["time_budget"] or None
+    return computation.result(time_budget)
+
+
+def precompute_valid_actions(env, game_path):
+    """
+    Starts working out the valid actions for the environment's current game
+    state in the background, so they're ready if a parser error needs them
+    """
+    if not config["valid_actions"]["precompute"]:
+        return
+
+    key = game_state_key(env, game_path)
+    with _in_progress_lock:
+        if key in _valid_actions or key in _in_progress:
+            return
+    _precompute_pool.submit(_precompute, get_current_state(), game_path, env.get_state())
+
+
+def _precompute(session, game_path, game_state):
+    env = get_thread_env(game_path)
+    env.set_state(game_state)
+    try:
+        get_valid_actions(env, game_path)
+    except Exception as e:
+        # Worked out again if a parser error needs them
+        increment_counter("valid_actions_precompute_failures_total")
+        # Only to a log the session already has, since worker processes import this
+        # module, and shouldn't have to load the LLM clients
+        if session and session.debug_log:
+            session.debug_log.write(f"=== VALID ACTIONS PRECOMPUTE FAILED ===\n{e!r}\n\n")
+
+
+def valid_actions_cache_stats():
+    return {
+        "valid_actions_cache_hits": _valid_actions.hits,
+        "valid_actions_cache_misses": _valid_actions.misses,
+        "valid_actions_partial_results": _partial_results,
+    }
+
+
+class _Computation:
+    """
+    The valid actions for one game state, as chunks of candidate actions
+    come back from the worker processes
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []  # each chunk's [(world diff, actions)], or None until it's done
+        self.remaining = 0
+        self.failed = False
+        self.actions = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, env, game_path):
+        try:
+            candidates = _candidate_actions(env)
+            workers = config["valid_actions"]["workers"]
+            pool = _get_worker_pool([game_path]) if workers and candidates else None
+            if pool is None:
+                # Tested right here, on the environment itself, including while
+                # the worker processes are still starting up
+                self.chunks = [_filter_candidates(env, candidates)]
+                self._finish()
+                return
+
+            chunk_count = min(workers * config["valid_actions"]["chunks_per_worker"], len(candidates))
+            # In order, so ties between actions with the same effect are broken
+            # the same way as when testing them all at once
+            chunk_size = -(-len(candidates) // chunk_count)
+            chunks = [candidates[i : i + chunk_size] for i in range(0, len(candidates), chunk_size)]
+            chunk_count = len(chunks)
+            self.chunks = [None] * chunk_count
+            self.remaining = chunk_count
+            self.game_path = game_path
+            self.game_state = env.get_state()
+
+            for i, chunk in enumerate(chunks):
+                try:
+                    future = pool.submit(_filter_chunk, game_path, self.game_state, chunk)
+                except BrokenProcessPool:
+                    _discard_worker_pool(pool)
+                    # The rest are tested right here, on the environment itself
+                    for j in range(i, chunk_count):
+                        self._chunk_filtered(j, _filter_candidates(env, chunks[j]))
+                    break
+                future.add_done_callback(
+                    lambda future, i=i, chunk=chunk: self._chunk_done(i, chunk, future, pool)
+                )
+        except Exception:
+            self.failed = True
+            self._finish()
+            raise
+
+    def _chunk_done(self, index, chunk, future, pool):
+        try:
+            self._chunk_filtered(index, future.result())
+        except BrokenProcessPool:
+            # A worker died, so the next computation gets a new pool, and this
+            # chunk is tested here instead, on an environment of its own
+            _discard_worker_pool(pool)
+            try:
+                env = create_env(self.game_path)
+                try:
+                    env.set_state(self.game_state)
+                    self._chunk_filtered(index, _filter_candidates(env, chunk))
+                finally:
+                    env.close()
+            except Exception:
+                self._chunk_filtered(index, None, failed=True)
+        except Exception:
+            self._chunk_filtered(index, None, failed=True)
+
+    def _chunk_filtered(self, index, result, failed=False):
+        with self._lock:
+            self.chunks[index] = result
+            self.failed = self.failed or failed
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self.actions = self._merge()
+        with _in_progress_lock:
+            _in_progress.pop(self.key, None)
+            # A chunk that failed would leave out actions, so try again next time
+            if not self.failed:
+                _valid_actions.put(self.key, self.actions)
+        self.done.set()
+
+    def _merge(self):
+        # Merged in chunk order, so the result doesn't depend on which finished first
+        diff2acts = {}
+        for chunk in self.chunks:
+            for diff, actions in chunk or ():
+                diff2acts.setdefault(diff, []).extend(actions)
+        return [max(actions, key=verb_usage_count) for actions in diff2acts.values()]
+
+    def result(self, timeout=None):
+        if self.done.wait(timeout):
+            return self.actions
+        global _partial_results
+        with _in_progress_lock:
+            _partial_results += 1
+        with self._lock:
+            return self._merge()
+
+
+def _candidate_actions(env):
+    """
+    The actions worth testing in the environment's current game state; the
+    first half of FrotzEnv.get_valid_actions()
+    """
+    if not env.is_fully_supported or not env.act_gen:
+        return []
+    if env.game_over() or env.victory() or env._emulator_halted():
+        return []
+
+    interactive_objs = env._identify_interactive_objects(use_object_tree=True)
+    best_obj_names = env._score_object_names(interactive_objs)
+    return [
+        action.action if isinstance(action, TemplateAction) else action
+        for action in env.act_gen.generate_actions(best_obj_names)
+    ]
+
+
+def _filter_candidates(env, candidates):
+    """
+    Tests the candidate actions on the environment, returning which change the
+    game, grouped by the change they make; the second half of FrotzEnv.get_valid_actions()
+    """
+    if not candidates:
+        return []
+    diff2acts = env._filter_candidate_actions(candidates, use_ctypes=True, use_parallel=False)
+    return [(tuple(int(x) for x in diff), actions) for diff, actions in diff2acts.items()]
+
+
+def _filter_chunk(game_path, game_state, candidates):
+    # Runs in a worker process
+    env = get_thread_env(game_path)
+    env.set_state(game_state)
+    return _filter_candidates(env, candidates)
+
+
+def _warm_up_worker(game_paths):
+    # Runs in a worker process, so it's ready to test candidates for these games
+    for game_path in game_paths:
+        get_thread_env(game_path)
+
+
+def prewarm_worker_pool(game_paths=()):
+    """
+    Starts the worker processes in the background, each loading the given games,
+    so the first parser error doesn't have to wait for them
+    """
+    if config["valid_actions"]["workers"]:
+        _get_worker_pool(game_paths)
+
+
+def _get_worker_pool(game_paths=()):
+    """
+    Returns the worker pool, or None while its workers are still starting up.
+    Starts a new pool if there isn't one, with its workers loading the given games.
+    """
+    global _worker_pool, _worker_pool_ready
+    with _worker_pool_lock:
+        if _worker_pool is not None:
+            return _worker_pool if _worker_pool_ready.is_set() else None
+
+        workers = config["valid_actions"]["workers"]
+        # Spawned rather than forked, since this process has threads running
+        pool = _worker_pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        ready = _worker_pool_ready = threading.Event()
+        # Shut down before exiting. When this is itself a worker process (as in
+        # batch.py), exiting otherwise waits on these workers forever. Runs before
+        # the pool's queues are closed, which happens at priority 10.
+        multiprocessing_util.Finalize(None, pool.shutdown, exitpriority=20)
+
+    # One task per worker, each of which starts a worker while no others are idle
+    remaining = [workers]
+    remaining_lock = threading.Lock()
+
+    def warmed_up(future):
+        if isinstance(future.exception(), BrokenProcessPool):
+            _discard_worker_pool(pool)
+            return
+        with remaining_lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                ready.set()
+
+    try:
+        for _ in range(workers):
+            pool.submit(_warm_up_worker, list(game_paths)).add_done_callback(warmed_up)
+    except BrokenProcessPool:
+        _discard_worker_pool(pool)
+    return None
+
+
+def _discard_worker_pool(pool):
+    """
+    Shuts down a pool that a worker died in, so the next computation starts a new one
+    """
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is pool:
+            _worker_pool = None
+    pool.shutdown(wait=False)
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import threading
+
+from jericho.util import get_subtree
+
+from env_pool import get_story_bytes
+from state import config
+
+VOCAB_ARTIFACT_VERSION = 1
+
+
+class Vocabulary:
+    """
+    The words a game's parser understands, split by part of speech, along with
+    the pre-rendered parser preamble used when asking the LLM to fix commands.
+    """
+
+    def __init__(self, verbs, nouns, prepositions):
+        self.verbs = verbs
+        self.nouns = nouns
+        self.prepositions = prepositions
+        self.parser_preamble = render_parser_preamble(verbs, nouns)
+
+        # The dictionary only stores the first few letters of each word
+        self.word_length = max([len(w) for w in verbs + nouns + prepositions] or [0])
+        self.words = set(verbs + nouns + prepositions)
+        self.template_verbs = None  # verbs used by the valid action templates, found on first use
+
+
+# Vocabulary indices by game path, shared by all sessions in this process
+_vocabularies = {}
+_vocabularies_lock = threading.Lock()
+
+
+def format_word_list(words):
+    return ", ".join([f'"{w}"' for w in words])
+
+
+def render_parser_preamble(verbs, nouns):
+    preamble = config["errors"]["parser_preamble"].replace(
+        "{{{verbs}}}", format_word_list(verbs)
+    )
+    return preamble.replace("{{{nouns}}}", format_word_list(nouns))
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text
+    return len(text) // 4
+
+
+def get_parser_preamble(env, game_path, valid_actions):
+    """
+    Returns the parser preamble for fixing a command in the current game state.
+    If the game's full vocabulary is over the token budget, only lists the words
+    relevant here: those in the valid actions, nouns for objects around the player,
+    and verbs the game's action templates use, dropping the least relevant words
+    until it fits. Falls back to the full vocabulary if there's no way to tell
+    what's in scope.
+    """
+    vocab = get_vocabulary(env, game_path)
+    budget = config["errors"]["vocab_token_budget"]
+    if not config["errors"]["vocab_scope"] or estimate_tokens(vocab.parser_preamble) <= budget:
+        return vocab.parser_preamble
+
+    player_location = env.get_player_location()
+    if player_location is None or not valid_actions:
+        return vocab.parser_preamble
+
+    verb_set = set(vocab.verbs) | set(vocab.prepositions)
+    # Many words are flagged as both, but in a command they're more useful as verbs
+    noun_set = set(vocab.nouns) - verb_set
+
+    def dictionary_words(phrases, word_set, skip_verb=False):
+        words = []
+        for phrase in phrases:
+            phrase_words = phrase.lower().split()
+            if skip_verb:
+                phrase_words = phrase_words[1:]
+            words.extend([w[: vocab.word_length] for w in phrase_words])
+        return [w for w in dict.fromkeys(words) if w in word_set]
+
+    # Objects around the player, from the object tree
+    nearby_objects = get_subtree(player_location.child, env.get_world_objects())
+    if vocab.template_verbs is None and env.act_gen:
+        vocab.template_verbs = dictionary_words(env.act_gen.templates, verb_set)
+
+    # Most relevant first
+    verbs = dictionary_words(valid_actions, verb_set) + (vocab.template_verbs or [])
+    nouns = dictionary_words(valid_actions, noun_set, skip_verb=True) + dictionary_words(
+        [o.name for o in nearby_objects], noun_set
+    )
+    verbs = list(dict.fromkeys(verbs))
+    nouns = list(dict.fromkeys(nouns))
+
+    # Drop words from the end of the longer list until it fits the budget
+    preamble = render_parser_preamble(verbs, nouns)
+    while estimate_tokens(preamble) > budget and (verbs or nouns):
+        if len(verbs) > len(nouns):
+            verbs = verbs[:-1]
+        else:
+            nouns = nouns[:-1]
+        preamble = render_parser_preamble(verbs, nouns)
+    return preamble
+
+
+def get_vocabulary(env, game_path):
+    """
+    Returns the vocabulary index for the given story file, building it from
+    the Frotz environment only the first time any session asks for it.
+    """
+    vocab = _vocabularies.get(game_path)
+    if vocab:
+        return vocab
+
+    with _vocabularies_lock:
+        if game_path not in _vocabularies:
+            _vocabularies[game_path] = _load_or_build_vocabulary(env, game_path)
+        return _vocabularies[game_path]
+
+
+def _artifact_path(game_path):
+    return f"{game_path}.vocab.json"
+
+
+def _story_md5(game_path):
+    return hashlib.md5(get_story_bytes(game_path)).hexdigest()
+
+
+def _load_or_build_vocabulary(env, game_path):
+    use_artifact = config["cache"]["vocab_on_disk"]
+    story_md5 = _story_md5(game_path) if use_artifact else None
+
+    if use_artifact:
+        try:
+            with open(_artifact_path(game_path), "r") as f:
+                artifact = json.load(f)
+            # Only trust the artifact if it was built from this exact story file
+            if (
+                artifact["version"] == VOCAB_ARTIFACT_VERSION
+                and artifact["story_md5"] == story_md5
+            ):
+                return Vocabulary(
+                    artifact["verbs"], artifact["nouns"], artifact["prepositions"]
+                )
+        except (OSError, ValueError, KeyError):
+            pass
+
+    dictionary = env.get_dictionary()
+    verbs = [w.word for w in dictionary if w.is_verb]
+    nouns = [w.word for w in dictionary if w.is_noun]
+    prepositions = [w.word for w in dictionary if w.is_prep]
+
+    if use_artifact:
+        artifact = {
+            "version": VOCAB_ARTIFACT_VERSION,
+            "story_md5": story_md5,
+            "verbs": verbs,
+            "nouns": nouns,
+            "prepositions": prepositions,
+        }
+        # Write to a temp file first so concurrent readers never see a partial
+        # artifact. The games directory may be read-only (e.g. in a Modal
+        # image), in which case we simply keep the in-memory index.
+        tmp_path = f"{_artifact_path(game_path)}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(artifact, f)
+            os.replace(tmp_path, _artifact_path(game_path))
+        except OSError:
+            pass
+
+    return Vocabulary(verbs, nouns, prepositions)
@@ -1,5 +1,8 @@
-import mmap
+import asyncio
+import contextvars
+import functools
 import json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import modal
@@ -18,7 +21,7 @@ web_api_image = (
     .add_local_dir(static_path, remote_path="/root/assets")
     .add_local_dir(config_path, remote_path="/root/configs")
     .add_local_dir(game_path, remote_path="/root/games")
-    .add_local_python_source("common", "engine", "game", "llm_serve", "splitscreen", "state", "utils")
+    .add_local_python_source("async_engine", "cache", "cassette", "common", "debuglog", "engine", "env_pool", "game", "gamelog", "llm_serve", "local_fix", "prefetch", "rewrites", "snapshot", "splitscreen", "state", "storage", "stub_llm", "tracing", "utils", "valid_actions", "vocab")
 )
 
 
@@ -29,14 +32,30 @@ web_api_image = (
     timeout=600,
     image=web_api_image,
 )
+@modal.concurrent(max_inputs=32)
 @modal.asgi_app()
 def web():
     from fastapi import FastAPI, Request, HTTPException
     from fastapi.middleware.cors import CORSMiddleware
     from fastapi.responses import Response, StreamingResponse
     from fastapi.staticfiles import StaticFiles
-    import engine
+    import async_engine
+    import debuglog
+    import env_pool
+    import game
+    import prefetch
     import state
+    import tracing
+    import utils
+    import valid_actions
+
+    # Get emulators, and the processes working out valid actions, ready for
+    # new games in the background
+    game_paths = [
+        f"games/{name}" for name in sorted(os.listdir("games")) if name.endswith((".z5", ".z8"))
+    ]
+    env_pool.prewarm_env_pools(game_paths)
+    valid_actions.prewarm_worker_pool(game_paths)
 
     web_app = FastAPI()
     llm = LLM()
@@ -49,38 +68,78 @@ def web():
         max_age=3600,
     )
 
-    @web_app.post("/start_game")
-    async def start_game(request: Request):
-        # Take in request string for a game name and initializes the game engine.
-        # Should return the initial state of the game
-        body = await request.json()
-        game_path = f"games/{body['game_id']}"
-        llm_provider = body["llm_provider"]
-        tone = body.get("tone")
-
-        new_state = state.init_game_state(
-            game_path,
-            llm_provider,
-            tone,
-            id_in_log_path=True,
+    @web_app.on_event("shutdown")
+    def shutdown():
+        # Make sure any sessions we haven't written back yet are saved
+        state.evict_idle_live_states(evict_all=True)
+
+    # Turns run on the event loop, with the steps that block (the emulator, LLM
+    # calls and the session store) on worker threads, so one player's slow turn
+    # doesn't hold up everyone else's requests
+    turn_pool = ThreadPoolExecutor(max_workers=state.config["sessions"]["turn_workers"])
+
+    @web_app.on_event("startup")
+    async def startup():
+        # The async engine's steps use the default executor
+        asyncio.get_running_loop().set_default_executor(turn_pool)
+
+    async def run_in_turn_pool(fn, *args):
+        # Runs in a copy of the request's context, so it sees the session
+        # the request has set as current
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            turn_pool, functools.partial(context.run, fn, *args)
         )
-        new_state.post_debug_log_write = vol.commit
-        state.set_current_state(new_state)
 
-        input_command, game_command, game_response, llm_response, is_game_over = (
-            engine.start_new_game()
-        )
+    async def acquire_session_lock(game_id):
+        # One turn at a time per player, in case of repeated requests. Waits on
+        # the event loop rather than in a worker thread, since a streaming turn
+        # holding the lock needs worker threads to finish.
+        session_lock = state.get_session_lock(game_id)
+        while not session_lock.acquire(blocking=False):
+            await asyncio.sleep(0.01)
+        return session_lock
+
+    async def run_turn(loaded_state, run, trace=False):
+        # Runs one turn for the session, optionally including the timings
+        # of each step of the turn in the response
+        loaded_state.post_debug_log_write = vol.commit
+        state.set_current_state(loaded_state)
 
-        state.save_state(new_state)
+        if trace:
+            tracing.start_trace()
+        try:
+            input_command, game_command, game_response, llm_response, is_game_over = await run()
+        finally:
+            turn_trace = tracing.end_trace()
 
-        return {
-            "id": new_state.id,
+        await run_in_turn_pool(state.save_live_state, loaded_state)
+
+        result = {
+            "id": loaded_state.id,
             "input_command": input_command,
             "game_command": game_command,
             "game_response": game_response,
             "llm_response": llm_response,
             "is_game_over": is_game_over,
         }
+        if turn_trace:
+            result["trace"] = turn_trace.to_json()
+        return result
+
+    @web_app.post("/start_game")
+    async def start_game(request: Request):
+        # Take in request string for a game name and initializes the game engine.
+        # Should return the initial state of the game
+        body = await request.json()
+        game_path = f"games/{body['game_id']}"
+        llm_provider = body["llm_provider"]
+        tone = body.get("tone")
+
+        new_state = await run_in_turn_pool(
+            lambda: state.init_game_state(game_path, llm_provider, tone, id_in_log_path=True)
+        )
+        return await run_turn(new_state, async_engine.start_new_game_async, body.get("trace"))
 
     @web_app.post("/user_command")
     async def user_command(request: Request):
@@ -88,25 +147,62 @@ def web():
         game_id = body["game_id"]
         input_command = body["input"]
 
-        loaded_state = state.load_state_by_id(game_id)
-        loaded_state.post_debug_log_write = vol.commit
-        state.set_current_state(loaded_state)
+        async def process():
+            try:
+                loaded_state = await run_in_turn_pool(state.load_live_state, game_id)
+                return await run_turn(
+                    loaded_state,
+                    lambda: async_engine.process_input_async(input_command),
+                    body.get("trace"),
+                )
+            finally:
+                session_lock.release()
+
+        session_lock = await acquire_session_lock(game_id)
+        # In a task of its own, which holds the lock until the turn is done,
+        # even if the request is cancelled while the turn is still running
+        return await asyncio.shield(asyncio.ensure_future(process()))
+
+    @web_app.post("/user_command_stream")
+    async def user_command_stream(request: Request):
+        # Same as /user_command, but streams newline delimited JSON events:
+        # the game response as soon as it's known, then each piece of the
+        # rewritten response as the LLM generates it.
+        body = await request.json()
+        game_id = body["game_id"]
+        input_command = body["input"]
 
-        input_command, game_command, game_response, llm_response, is_game_over = (
-            engine.process_input(input_command)
+        async def _gen():
+            session_lock = await acquire_session_lock(game_id)
+            try:
+                loaded_state = await run_in_turn_pool(state.load_live_state, game_id)
+                loaded_state.post_debug_log_write = vol.commit
+                state.set_current_state(loaded_state)
+                events = async_engine.process_input_stream_async(input_command)
+                try:
+                    async for event in events:
+                        event["id"] = loaded_state.id
+                        yield json.dumps(event) + "\n"
+                finally:
+                    # Save even if the client hangs up, since the command has already run
+                    await events.aclose()
+                    await run_in_turn_pool(state.save_live_state, loaded_state)
+            finally:
+                session_lock.release()
+
+        return StreamingResponse(_gen(), media_type="application/x-ndjson")
+
+    @web_app.get("/metrics")
+    def metrics():
+        # Time spent in each step of turns, LLM token usage and cache hit rates,
+        # since this container started, in Prometheus' text format
+        gauges = game.cache_stats()
+        gauges.update({f"prompt_{k}": v for k, v in utils.prompt_cache_stats.items()})
+        gauges.update({f"prefetch_{k}": v for k, v in prefetch.prefetch_stats.items()})
+        return Response(
+            tracing.render_metrics(gauges), media_type="text/plain; version=0.0.4"
         )
 
-        state.save_state(loaded_state)
-
-        return {
-            "id": loaded_state.id,
-            "input_command": input_command,
-            "game_command": game_command,
-            "game_response": game_response,
-            "llm_response": llm_response,
-            "is_game_over": is_game_over,
-        }
-
     @web_app.post("/warm_inference")
     def warm_inference(request: Request):
         llm.warm_up.remote_gen()
@@ -114,36 +210,23 @@ def web():
 
     @web_app.post("/tail_log")
     async def tail_log(request: Request):
+        # Returns the last 250 lines of the session's debug log by default.
+        # Give "since" to get only lines from there on (e.g. the "end" of the last
+        # response, to poll for new output), or "before" to scroll back from there
+        # (e.g. the "start" of the earliest response seen).
         body = await request.json()
         game_state_id = body["game_state_id"]
-        # TODO: Add a pagination / scroll back mechanism
-        # Simplest implementation for now to just return last 250 rows of text.
 
-        output = ""
         filename = f"logs/debug-{game_state_id}.log"
         vol.reload()  # Needs a reload to get latest file state
-        try:
-            with open(filename, "rb") as f:
-                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-
-                try:
-                    # Start from the end of the file
-                    current_pos = mm.size() - 1
-                    lines_found = 0
-
-                    # Move backwards until we find N newlines or reach the start
-                    while current_pos >= 0 and lines_found < 250:
-                        if mm[current_pos] == ord("\n"):
-                            lines_found += 1
-                        current_pos -= 1
-
-                    # Read from the position after the Nth newline to the end
-                    return {"log": mm[current_pos + 2 :].decode("utf-8")}
-
-                finally:
-                    mm.close()
-        except FileNotFoundError:
+        log = debuglog.read_log(
+            filename, since=body.get("since"), before=body.get("before"), count=250
+        )
+        if log is None:
+            if body.get("since") is not None or body.get("before") is not None:
+                return {"log": "", "start": 0, "end": 0}
             return {"log": "<file not found>"}
+        return log
 
     @web_app.post("/inference")
     async def inference(request: Request):